@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Admission control: limits the number of upstream-heavy requests processed at the same time and answers excess ones quickly
+# with "503 Service Unavailable", so that cheap requests (static files, login form) are still served while Proxmox is slow
+
+import cherrypy
+import threading
+
+
+class ServiceUnavailable(cherrypy.HTTPError):
+    """HTTP error 503 including a "Retry-After" header (CherryPy removes that header from error responses otherwise)"""
+
+    def __init__(self, retry_after, message=None):
+        """Object initialization"""
+        super().__init__(503, message)
+        self.retry_after = retry_after
+
+    def set_response(self):
+        """Set the error response incl. "Retry-After" header"""
+        super().set_response()
+        cherrypy.serving.response.headers['Retry-After'] = str(self.retry_after)
+
+
+class AdmissionControl():
+    """Decides per request whether to process it or to shed it"""
+
+    def __init__(self, max_active, queue_threshold, retry_after=5, cheap_paths=None):
+        """Object initialization
+        max_active: maximum number of upstream-heavy requests processed at the same time (the remaining worker threads serve cheap ones)
+        queue_threshold: upstream-heavy requests are shed while more connections than this wait for a worker thread"""
+        self.max_active = max_active
+        self.queue_threshold = queue_threshold
+        self.retry_after = retry_after
+        self.cheap_paths = cheap_paths if (cheap_paths is not None) else ['/static', '/favicon.ico', '/login_screen', '/logout']
+        self.lock = threading.Lock()
+        self.active = 0
+        self.admitted = 0
+        self.shed = dict() # reason -> number of shed requests
+        self.queue_depth_max = 0
+
+    def queue_depth(self):
+        """Return the number of accepted connections waiting for a worker thread"""
+        try:
+            return cherrypy.server.httpserver.requests.qsize
+        except AttributeError: # server not started
+            return 0
+
+    def is_cheap(self, request):
+        """Whether the request can be answered without calling the Proxmox API"""
+        path = request.path_info
+        if any([ (path == prefix) or path.startswith(prefix + '/') for prefix in self.cheap_paths ]):
+            return True
+        # Requests without login are answered with the login form (except for the login itself)
+        authenticated = hasattr(cherrypy, 'session') and (cherrypy.session.get('username') is not None)
+        return (not authenticated) and not (path.endswith('do_login') or path.startswith('/redirect_uri'))
+
+    def admit(self):
+        """Process the current request or shed it with status 503 (to be called before the page handler)"""
+        request = cherrypy.request
+        depth = self.queue_depth()
+        with self.lock:
+            self.queue_depth_max = max(self.queue_depth_max, depth)
+        if self.is_cheap(request):
+            return
+        proxmox = cherrypy.session.get('proxmox') if hasattr(cherrypy, 'session') else None
+        if depth > self.queue_threshold:
+            reason = 'queue'
+        elif (proxmox is not None) and not proxmox.is_available():
+            reason = 'upstream'
+        else:
+            with self.lock:
+                if self.active < self.max_active:
+                    self.active += 1
+                    self.admitted += 1
+                    request.hooks.attach('on_end_request', self.release)
+                    return
+            reason = 'busy'
+        with self.lock:
+            self.shed[reason] = self.shed.get(reason, 0) + 1
+        raise ServiceUnavailable(self.retry_after, 'MyProx is busy at the moment - please try again in a few seconds')
+
+    def release(self):
+        """Mark the admitted request as finished"""
+        with self.lock:
+            self.active -= 1
+
+    def metrics(self):
+        """Return the current metrics as dictionary (the maximum queue depth is reset on each call)"""
+        with self.lock:
+            result = {
+                'active': self.active,
+                'max_active': self.max_active,
+                'queue_depth': self.queue_depth(),
+                'queue_depth_max': self.queue_depth_max,
+                'admitted': self.admitted,
+                'shed': sum(self.shed.values()),
+                'shed_by_reason': dict(self.shed),
+            }
+            self.queue_depth_max = 0
+        return result
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Structured audit log (JSON lines) written by a background thread so that request handling never waits for disk I/O
+
+import cherrypy
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class AuditLog():
+    """Queue-backed writer of audit events with batching and size/time-based rotation"""
+
+    def __init__(self, filename, max_bytes=10485760, rotate_seconds=86400, backup_count=7, queue_size=10000, batch_size=100, flush_interval=1.0):
+        """Instance initialization; no events are written if filename is empty"""
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0 # number of events dropped in total due to a full queue
+        self._dropped_reported = 0
+        self._dropped_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._file = None
+        self._next_rotation = None
+
+    @property
+    def enabled(self):
+        """Whether audit logging is enabled"""
+        return bool(self.filename)
+
+    def log(self, event, **fields):
+        """Queue an audit event; never blocks (events are dropped and counted if the queue is full)"""
+        if not self.enabled:
+            return
+        record = {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'), 'event': event}
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def start(self):
+        """Start the background writer thread"""
+        if (not self.enabled) or (self._thread is not None):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name='Audit log writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background writer thread after writing all queued events"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def run(self):
+        """Main loop of the background writer thread"""
+        while True:
+            batch = self.get_batch()
+            if batch:
+                try:
+                    self.write(batch)
+                except OSError as e:
+                    cherrypy.log(f'Could not write audit log [{self.filename}]: {str(e)}', context='AUDIT', severity=logging.ERROR, traceback=False)
+                    self.close()
+            elif self._stop_event.is_set():
+                break
+        self.close()
+
+    def get_batch(self):
+        """Wait for queued events and return them as a batch"""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        # Record the number of dropped events in the audit log itself
+        dropped = self.dropped
+        if dropped != self._dropped_reported:
+            batch.append({'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+                          'event': 'audit_dropped', 'count': dropped - self._dropped_reported, 'total': dropped})
+            self._dropped_reported = dropped
+        return batch
+
+    def write(self, batch):
+        """Write a batch of events to the log file (rotating it if needed)"""
+        if self._file is None:
+            self.open()
+        elif (self._file.tell() >= self.max_bytes) or (time.time() >= self._next_rotation):
+            self.rotate()
+        data = ''.join([json.dumps(record, default=str) + '\n' for record in batch])
+        self._file.write(data)
+        self._file.flush()
+
+    def open(self):
+        """Open the log file for appending"""
+        self._file = open(self.filename, 'a', encoding='utf-8')
+        self._next_rotation = time.time() + self.rotate_seconds
+
+    def close(self):
+        """Close the log file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def rotate(self):
+        """Rotate the log files ('audit.log' -> 'audit.log.1' -> 'audit.log.2' ...) and open a new one"""
+        self.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f'{self.filename}.{i}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.filename}.{i + 1}')
+            os.replace(self.filename, f'{self.filename}.1')
+        else:
+            os.remove(self.filename)
+        self.open()
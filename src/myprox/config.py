@@ -177,12 +177,110 @@ class Configuration():
                 domain = None
         return domain
 
+    @property
+    def audit_log_file(self):
+        """File to write the structured audit log (JSON lines) to; audit logging is disabled if not set"""
+        return self.get('audit_log_file', '')
+
+    @property
+    def audit_log_max_bytes(self):
+        """Size in bytes at which the audit log file is rotated"""
+        return int(self.get('audit_log_max_bytes', 10485760))
+
+    @property
+    def audit_log_rotate_seconds(self):
+        """Number of seconds after which the audit log file is rotated"""
+        return int(self.get('audit_log_rotate_seconds', 86400))
+
+    @property
+    def audit_log_backup_count(self):
+        """Number of rotated audit log files to keep"""
+        return int(self.get('audit_log_backup_count', 7))
+
+    @property
+    def audit_log_queue_size(self):
+        """Maximum number of audit events waiting to be written; further events are dropped (and counted)"""
+        return int(self.get('audit_log_queue_size', 10000))
+
+    @property
+    def inventory_snapshot_file(self):
+        """SQLite file to persist the last known machine lists to; served (marked as stale) after a restart while refreshing (disabled if not set)"""
+        return self.get('inventory_snapshot_file', '')
+
+    @property
+    def inventory_snapshot_max_age(self):
+        """Number of seconds after which a persisted machine list is no longer served"""
+        return int(self.get('inventory_snapshot_max_age', 86400))
+
+    @property
+    def inventory_resync_interval(self):
+        """Number of seconds between complete retrievals of a machine list; in between, it is updated following the cluster task log (0: always retrieve completely)"""
+        return int(self.get('inventory_resync_interval', 0))
+
     @property
     def login_caption(self):
         """Greeting text (in HTML format) to show on the login form"""
         default = '<h3 style="text-align: center; margin-bottom: 2em;">Welcome!</h3>'
         return self.get('login_caption', default)
 
+    @property
+    def server_thread_pool(self):
+        """Number of worker threads of the web server"""
+        return max(2, int(self.get('server_thread_pool', 30)))
+
+    @property
+    def server_accepted_queue_size(self):
+        """Maximum number of accepted connections waiting for a worker thread; further connections are answered with status 503"""
+        return int(self.get('server_accepted_queue_size', 100))
+
+    @property
+    def server_socket_queue_size(self):
+        """Maximum number of connections waiting to be accepted by the web server (listen backlog)"""
+        return int(self.get('server_socket_queue_size', 64))
+
+    @property
+    def session_locking(self):
+        """How requests of the same session are locked: 'explicit' only locks requests changing the session or a machine,
+        'implicit' processes all requests of a session one after another"""
+        value = self.get('session_locking', 'explicit')
+        return value if value in ['explicit', 'implicit'] else 'implicit'
+
+    @property
+    def admission_reserved_threads(self):
+        """Number of worker threads kept free from requests calling the Proxmox API (for static files, login form etc.)"""
+        return int(self.get('admission_reserved_threads', 2))
+
+    @property
+    def admission_queue_threshold(self):
+        """Requests calling the Proxmox API are rejected with status 503 while more connections than this wait for a worker thread"""
+        return int(self.get('admission_queue_threshold', 20))
+
+    @property
+    def admission_retry_after(self):
+        """Number of seconds after which clients are asked to retry rejected requests ("Retry-After" header)"""
+        return int(self.get('admission_retry_after', 5))
+
+    @property
+    def metrics_interval(self):
+        """Number of seconds between logging the metrics of the request admission and of calls to the Proxmox API (0 disables logging)"""
+        return int(self.get('metrics_interval', 300))
+
+    @property
+    def federation(self):
+        """Whether users are logged in at all federated nodes at once and see the merged list of their machines"""
+        return self.is_true(self.get('federation', 0))
+
+    @property
+    def federation_nodes(self):
+        """The nodes (config sections) used in federated mode (default: all nodes)"""
+        nodes = [ node.strip() for node in self.get('federation_nodes', '').split(',') if node.strip() ]
+        return [ node for node in nodes if node in self.nodes ] or list(self.nodes.keys())
+
+    @property
+    def federation_timeout(self):
+        """Number of seconds to wait for the nodes in federated mode; slower nodes are reported as unavailable"""
+        return float(self.get('federation_timeout', 5))
+
     def shortcut_user(self, node):
         """The user to be used in case '.' is provided as username"""
         return self.get('shortcut_user', '', node)
@@ -199,6 +297,58 @@ class Configuration():
         """Number of days from today when setting a new expiry date"""
         return int(self.get('expiry_prolongation_days', 365, node))
 
+    def permissions_cache_ttl(self, node):
+        """Number of seconds the effective permissions of a user are cached (used to only offer permitted actions)"""
+        return int(self.get('permissions_cache_ttl', 300, node))
+
+    def usage_cache_ttl(self, node):
+        """Number of seconds the resource usage history of a machine is cached"""
+        return int(self.get('usage_cache_ttl', 60, node))
+
+    def upstream_concurrency(self, node):
+        """Maximum number of concurrent calls to the Proxmox API of a node; further calls wait (queue time is logged, see metrics_interval)"""
+        return max(1, int(self.get('upstream_concurrency', 8, node)))
+
+    def start_console_timeout(self, node):
+        """Number of seconds to wait for a machine to start before opening its console"""
+        return int(self.get('start_console_timeout', 60, node))
+
     def dryrun(self, node):
         """Define whether to disable sending any writing/changing requests to Proxmox API"""
         return self.is_true(self.get('dryrun', 0, node))
+
+    def sweeper_user(self, node):
+        """Service user used by the background expiry sweeper (the sweeper is disabled if not set)"""
+        return self.get('sweeper_user', '', node)
+
+    def sweeper_password(self, node):
+        """Password of the sweeper service user (not needed if an API token is used)"""
+        return self.get('sweeper_password', None, node)
+
+    def sweeper_token_name(self, node):
+        """Name of the API token of the sweeper service user (alternative to password)"""
+        return self.get('sweeper_token_name', None, node)
+
+    def sweeper_token_value(self, node):
+        """Secret value of the API token of the sweeper service user"""
+        return self.get('sweeper_token_value', None, node)
+
+    def sweeper_interval(self, node):
+        """Number of seconds between two runs of the expiry sweeper"""
+        return int(self.get('sweeper_interval', 3600, node))
+
+    def sweeper_warn_days(self, node):
+        """Number of days before expiry from which on a machine is considered as expiring soon"""
+        return int(self.get('sweeper_warn_days', 14, node))
+
+    def sweeper_action(self, node):
+        """Action to apply to expired machines ('report' only reports them; or 'shutdown', 'stop', 'suspend')"""
+        return self.get('sweeper_action', 'report', node)
+
+    def sweeper_action_delay(self, node):
+        """Number of seconds to wait between two actions of the expiry sweeper (to spread load on the Proxmox API)"""
+        return float(self.get('sweeper_action_delay', 10, node))
+
+    def sweeper_report_file(self, node):
+        """File to write the expiry report to (format 'json' or 'csv' is derived from the file extension); only logged if not set"""
+        return self.get('sweeper_report_file', '', node)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Federated mode: a user session spans several Proxmox endpoints (config sections) at once
+
+import concurrent.futures
+import threading
+
+from . import proxapi
+
+
+# Threads shared by all sessions for calling the endpoints concurrently (bounded, so that hung endpoints can't pile up threads)
+max_workers = 16
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set() # futures of calls not finished yet (cancelled on shutdown)
+
+
+def get_executor():
+    """Return the shared thread pool (created on first use)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='Federation')
+        return _executor
+
+def shutdown():
+    """Let the threads of the shared thread pool end (to be called when the server stops; the pool is recreated on next use)"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            for future in list(_pending):
+                future.cancel() # only succeeds for calls still waiting for a thread
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def run_concurrently(func, endpoints, timeout=None):
+    """Call func(endpoint) for all endpoints concurrently; returns dictionaries of results and of errors (exceptions) per endpoint"""
+    results = dict()
+    errors = dict()
+    if not endpoints:
+        return results, errors
+    executor = get_executor()
+    futures = { executor.submit(func, endpoint): endpoint for endpoint in endpoints }
+    with _executor_lock:
+        _pending.update(futures.keys())
+    for future in futures.keys():
+        future.add_done_callback(lambda future: _pending.discard(future)) # also called for cancelled futures
+    done, not_done = concurrent.futures.wait(futures.keys(), timeout=timeout)
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            errors[futures[future]] = e
+    for future in not_done:
+        future.cancel() # calls still waiting for a thread are dropped; running ones finish in the background
+        errors[futures[future]] = TimeoutError('No response in time')
+    return results, errors
+
+
+class FederatedMyProxAPI(proxapi.ProxAPI):
+    """Presents the MyProxAPI instances of several endpoints as one (helper methods are inherited, API calls are routed to the endpoints)
+    Guest ids carry the endpoint ('[type/]vmid@node@endpoint') since separate clusters may use the same node names"""
+
+    def __init__(self, apis, timeout=5, unavailable=None):
+        """Instance initialization (apis: dictionary of endpoint to MyProxAPI instance; unavailable: dictionary of endpoint to error message of endpoints not connected)"""
+        # Note: ProxAPI.__init__ is not called since there is no single Proxmox connection
+        self.apis = apis
+        self.timeout = timeout
+        self.unavailable = unavailable or dict()
+        self.failed = dict(self.unavailable) # endpoint -> error message of the last inventory request
+        self._clusters = dict() # endpoint -> identity of the cluster behind it (None if unknown)
+        self._node_endpoints = dict() # Proxmox node name -> endpoints (for ids without endpoint)
+        self._lock = threading.Lock() # the instance is shared by concurrent requests of the session
+
+    def is_available(self):
+        """Whether at least one of the endpoints is currently considered reachable"""
+        return any([ api.is_available() for api in self.apis.values() ])
+
+    def cluster_of(self, endpoint):
+        """Return the identity of the cluster behind the given endpoint (None if it can't be determined, e.g. for lack of permission)"""
+        with self._lock:
+            if endpoint in self._clusters:
+                return self._clusters[endpoint]
+        import proxmoxer # imported on demand to speed up startup
+        try:
+            identity = self.apis[endpoint].get_cluster_identity()
+        except proxmoxer.core.ResourceException:
+            identity = None # not permitted; don't ask again
+        except Exception:
+            return None # e.g. not reachable; ask again next time
+        with self._lock:
+            self._clusters[endpoint] = identity
+        return identity
+
+    def split_id(self, id):
+        """Return the id used at the endpoint and the endpoint of the given guest id (None if the id doesn't carry the endpoint)"""
+        if id is None:
+            raise ValueError('No vmid provided')
+        if id.count('@') < 2:
+            return id, None
+        local_id, _, endpoint = id.rpartition('@')
+        return local_id, endpoint
+
+    def federated_item(self, item, endpoint):
+        """Add the endpoint to the id of the given guest data"""
+        item['id'] = f"{item['id']}@{endpoint}"
+        item['endpoint'] = endpoint
+        with self._lock:
+            self._node_endpoints.setdefault(item['node'], set()).add(endpoint)
+        return item
+
+    def decompose_guest_id(self, id):
+        """Returns the guest type, vmid and node part of the provided id (format: '[type/]vmid@node@endpoint')"""
+        return super().decompose_guest_id(self.split_id(id)[0])
+
+    def get_virtual_machines(self, node=None, vmid=None, vmtype=None):
+        """Return the merged guests of all endpoints (guests of endpoints providing access to the same cluster are listed once);
+        endpoints that fail or are slow are left out and recorded in "failed" """
+        def get(endpoint):
+            return self.cluster_of(endpoint), self.apis[endpoint].get_virtual_machines(node=node)
+        results, errors = run_concurrently(get, sorted(self.apis.keys()), self.timeout)
+        self.failed = dict(self.unavailable, **{ endpoint: str(e) for endpoint, e in errors.items() }) # replaced, never changed in place
+        result = dict()
+        seen = set()
+        for endpoint in sorted(results.keys()):
+            cluster, machines = results[endpoint]
+            for item in machines.values():
+                # Only guests of endpoints proven to be the same cluster are duplicates; the first endpoint wins
+                key = (cluster, item['id']) if (cluster is not None) else (endpoint, item['id'])
+                if key not in seen:
+                    seen.add(key)
+                    item = self.federated_item(item, endpoint)
+                    result[item['id']] = item
+        if vmid is not None:
+            for item in result.values():
+                if str(item['vmid']) == str(vmid):
+                    return item
+            return None
+        return result
+
+    def iter_virtual_machines(self):
+        """Yield the guests of all endpoints one endpoint after the other, skipping duplicates; if endpoints fail, the guests of the
+        others are yielded nevertheless, but an exception is raised at the end (the result is incomplete)"""
+        seen = set()
+        failed = dict()
+        for endpoint in sorted(self.apis.keys()):
+            try:
+                cluster = self.cluster_of(endpoint)
+                for item in self.apis[endpoint].iter_virtual_machines():
+                    key = (cluster, item['id']) if (cluster is not None) else (endpoint, item['id'])
+                    if key not in seen:
+                        seen.add(key)
+                        yield self.federated_item(item, endpoint)
+            except Exception as e:
+                failed[endpoint] = str(e)
+                with self._lock:
+                    self.failed = dict(self.failed, **{ endpoint: failed[endpoint] })
+        if failed:
+            raise Exception('Incomplete machine list; failed endpoints: ' + ', '.join([ f'{endpoint} [{error}]' for endpoint, error in failed.items() ]))
+
+    def endpoint_for(self, id):
+        """Return the endpoint hosting the given guest"""
+        local_id, endpoint = self.split_id(id)
+        if endpoint is not None:
+            if endpoint not in self.apis:
+                raise ValueError(f'endpoint {endpoint} is not known')
+            return endpoint
+        # Id without endpoint (e.g. from an older link): only accepted if its node name is unambiguous
+        vmid, node = self.decompose_id(id)
+        if node is None:
+            raise ValueError('node must be specified in federated mode')
+        with self._lock:
+            known = node in self._node_endpoints
+        if not known:
+            self.get_virtual_machines() # learn which endpoints host which nodes
+        with self._lock:
+            endpoints = set(self._node_endpoints.get(node, set())) # a copy; other requests may add endpoints
+        if not endpoints:
+            raise ValueError(f'node {node} is not known')
+        if len({ self.cluster_of(endpoint) or endpoint for endpoint in endpoints }) > 1:
+            raise ValueError(f'node {node} exists in several clusters; the endpoint must be specified')
+        return sorted(endpoints)[0]
+
+    def route(self, id):
+        """Return the MyProxAPI instance of the endpoint hosting the given guest and the id used there"""
+        return self.apis[self.endpoint_for(id)], self.split_id(id)[0]
+
+    def api_for(self, id):
+        """Return the MyProxAPI instance of the endpoint hosting the given guest"""
+        return self.route(id)[0]
+
+    def get_virtual_machine(self, id):
+        api, local_id = self.route(id)
+        data = api.get_virtual_machine(local_id)
+        return self.federated_item(data, self.endpoint_for(id)) if (data is not None) else None
+
+    def get_virtual_machine_with_tags(self, id):
+        api, local_id = self.route(id)
+        data = api.get_virtual_machine_with_tags(local_id)
+        return self.federated_item(data, self.endpoint_for(id)) if (data is not None) else None
+
+    def get_spice(self, id):
+        api, local_id = self.route(id)
+        return api.get_spice(local_id)
+
+    def trigger_vm_action(self, id, action):
+        api, local_id = self.route(id)
+        return api.trigger_vm_action(local_id, action)
+
+    def get_vm_status(self, id):
+        api, local_id = self.route(id)
+        return api.get_vm_status(local_id)
+
+    def wait_until_running(self, id, upid=None, timeout=60):
+        api, local_id = self.route(id)
+        return api.wait_until_running(local_id, upid, timeout=timeout)
+
+    def get_usage_history(self, id, timeframe='hour', points=60):
+        api, local_id = self.route(id)
+        return api.get_usage_history(local_id, timeframe, points)
+
+    def update_tags(self, id, changes, retries=5):
+        api, local_id = self.route(id)
+        return api.update_tags(local_id, changes, retries)
+
+    def set_tag_expiry_bydays(self, id, days=365):
+        api, local_id = self.route(id)
+        return api.set_tag_expiry_bydays(local_id, days)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+# Inventory snapshot: the last known machine list per endpoint and user, persisted to SQLite so that it can be served
+# (marked as stale) right after a restart while current data is fetched in the background
+# The database is written by a background thread (coalescing frequent updates) so that request handling never waits for disk I/O
+# Optionally, the machine list is kept current incrementally by following the cluster task log instead of re-reading it completely
+
+import cherrypy
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+# Task types after which the state of the affected guest is re-read
+status_task_types = ['qmstart', 'qmstop', 'qmshutdown', 'qmreboot', 'qmreset', 'qmsuspend', 'qmresume', 'qmpause', 'qmconfig',
+                     'vzstart', 'vzstop', 'vzshutdown', 'vzreboot', 'vzsuspend', 'vzresume']
+# Task types changing the set of guests or their nodes; they trigger a full resync
+resync_task_types = ['qmcreate', 'qmclone', 'qmrestore', 'qmdestroy', 'qmigrate', 'qmtemplate',
+                     'vzcreate', 'vzclone', 'vzrestore', 'vzdestroy', 'vzmigrate', 'vztemplate']
+
+
+def finished_tasks(tasks):
+    """Return the UPIDs of the finished tasks in the given task list"""
+    return { task['upid'] for task in tasks if task.get('endtime') }
+
+
+class Entry():
+    """Known machine list of an endpoint as seen by a user"""
+
+    def __init__(self, machines, updated, stale=False, synced=None, done=None):
+        """Object initialization (updated: time of retrieval; stale: loaded from the snapshot file, not fetched since startup;
+        synced: time of the last complete retrieval; done: UPIDs of finished tasks already reflected in the machine list, None if unknown)"""
+        self.machines = machines
+        self.updated = updated
+        self.stale = stale
+        self.synced = synced if (synced is not None) else updated
+        self.done = done
+
+
+class InventorySnapshot():
+    """In-memory inventory per endpoint and user that is written incrementally to an SQLite database and loaded on startup"""
+
+    def __init__(self, filename, max_age=86400, resync_interval=0, flush_interval=2.0, touch_interval=300, prune_interval=3600):
+        """Instance initialization; nothing is persisted if filename is empty
+        resync_interval: seconds between complete retrievals when following the task log (0 disables incremental updates)
+        flush_interval: seconds the background writer collects updates before writing them (only the latest one per user is written)
+        touch_interval: seconds after which the time of retrieval of an unchanged inventory is written again (keeps it from expiring)
+        prune_interval: seconds between removals of inventories older than max_age from the database"""
+        self.filename = filename
+        self.max_age = max_age
+        self.resync_interval = resync_interval
+        self.flush_interval = flush_interval
+        self.touch_interval = min(touch_interval, max_age / 2)
+        self.prune_interval = prune_interval
+        self.entries = dict() # (endpoint, user) -> Entry
+        self.refreshing = set() # (endpoint, user) of refreshes in progress
+        self.lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._written = dict() # (endpoint, user) -> dictionary of machine id to the JSON data on disk
+        self._written_updated = dict() # (endpoint, user) -> time of retrieval on disk
+        self._pending = dict() # (endpoint, user) -> (machines, updated) waiting to be written
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        """Whether machine lists are kept at all (for persisting them or for updating them incrementally)"""
+        return bool(self.filename) or (self.resync_interval > 0)
+
+    def log(self, severity, message):
+        """Log a message"""
+        cherrypy.log(message, context='INVENTORY', severity=severity, traceback=False)
+
+    def start(self):
+        """Open the database and load the inventories not older than max_age (they are served as stale until refreshed)"""
+        if (not self.filename) or (self._db is not None):
+            return
+        try:
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS scopes (endpoint TEXT, user TEXT, updated REAL, PRIMARY KEY (endpoint, user))')
+                self._db.execute('CREATE TABLE IF NOT EXISTS machines (endpoint TEXT, user TEXT, id TEXT, data TEXT, PRIMARY KEY (endpoint, user, id))')
+            self.prune()
+            self.load()
+        except (sqlite3.Error, OSError) as e:
+            self.log(logging.ERROR, f'Could not open inventory snapshot [{self.filename}]: {str(e)}')
+            self.stop()
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name='Inventory writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background writer thread after writing all pending inventories and close the database"""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def load(self):
+        """Load the inventories from the database"""
+        with self._db_lock:
+            scopes = self._db.execute('SELECT endpoint, user, updated FROM scopes WHERE updated >= ?', (time.time() - self.max_age,)).fetchall()
+            rows = self._db.execute('SELECT endpoint, user, id, data FROM machines').fetchall()
+        written = dict()
+        for endpoint, user, id, data in rows:
+            written.setdefault((endpoint, user), dict())[id] = data
+        with self.lock:
+            for endpoint, user, updated in scopes:
+                key = (endpoint, user)
+                machines = { id: json.loads(data) for id, data in written.get(key, dict()).items() }
+                self.entries[key] = Entry(machines, updated, stale=True)
+        self._written = written
+        self._written_updated = { (endpoint, user): updated for endpoint, user, updated in scopes }
+        self.log(logging.INFO, f'Loaded inventory snapshot of {len(scopes)} user(s) from [{self.filename}]')
+
+    def get(self, endpoint, user):
+        """Return the known inventory of the given endpoint and user (None if unknown)"""
+        with self.lock:
+            return self.entries.get((endpoint, user))
+
+    def put(self, endpoint, user, machines, synced=None, done=None):
+        """Remember the current inventory of the given endpoint and user; only changed machines are written to disk"""
+        if not self.enabled:
+            return
+        updated = time.time()
+        with self.lock:
+            self.entries[(endpoint, user)] = Entry(machines, updated, synced=synced, done=done)
+            if self._thread is not None:
+                self._pending[(endpoint, user)] = (machines, updated) # replaces an older update not written yet
+                self._wakeup.set()
+
+    def run(self):
+        """Main loop of the background writer thread"""
+        next_prune = time.monotonic() + self.prune_interval
+        while not self._stop_event.is_set():
+            self._wakeup.wait(timeout=self.prune_interval)
+            self._stop_event.wait(self.flush_interval) # collect further updates (returns at once when stopping)
+            self._wakeup.clear()
+            self.flush()
+            if time.monotonic() >= next_prune:
+                self.prune()
+                next_prune = time.monotonic() + self.prune_interval
+        self.flush()
+
+    def flush(self):
+        """Write all pending inventories"""
+        with self.lock:
+            pending, self._pending = self._pending, dict()
+        for key, (machines, updated) in pending.items():
+            self.write(key, machines, updated)
+
+    def write(self, key, machines, updated):
+        """Write the changes compared to the last written state of the given inventory to disk
+        (the time of retrieval of an unchanged inventory is only written again after touch_interval)"""
+        rows = { str(id): json.dumps(item, sort_keys=True, default=str) for id, item in machines.items() }
+        with self._db_lock:
+            if self._db is None:
+                return
+            written = self._written.get(key, dict())
+            changed = [ (*key, id, data) for id, data in rows.items() if written.get(id) != data ]
+            removed = [ (*key, id) for id in written.keys() if id not in rows ]
+            written_updated = self._written_updated.get(key)
+            if (not changed) and (not removed) and (written_updated is not None) and (updated - written_updated < self.touch_interval):
+                return
+            try:
+                with self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO machines (endpoint, user, id, data) VALUES (?, ?, ?, ?)', changed)
+                    self._db.executemany('DELETE FROM machines WHERE endpoint = ? AND user = ? AND id = ?', removed)
+                    self._db.execute('INSERT OR REPLACE INTO scopes (endpoint, user, updated) VALUES (?, ?, ?)', (*key, updated))
+                self._written[key] = rows
+                self._written_updated[key] = updated
+            except sqlite3.Error as e:
+                self.log(logging.WARNING, f'Could not write inventory snapshot [{self.filename}]: {str(e)}')
+
+    def prune(self):
+        """Remove the inventories older than max_age from the database (and stale ones from memory)"""
+        limit = time.time() - self.max_age
+        with self._db_lock:
+            if self._db is None:
+                return
+            try:
+                expired = self._db.execute('SELECT endpoint, user FROM scopes WHERE updated < ?', (limit,)).fetchall()
+                with self._db:
+                    self._db.execute('DELETE FROM scopes WHERE updated < ?', (limit,))
+                    self._db.execute('DELETE FROM machines WHERE NOT EXISTS '
+                                     '(SELECT 1 FROM scopes WHERE scopes.endpoint = machines.endpoint AND scopes.user = machines.user)')
+            except sqlite3.Error as e:
+                self.log(logging.WARNING, f'Could not prune inventory snapshot [{self.filename}]: {str(e)}')
+                return
+            for key in expired:
+                self._written.pop(tuple(key), None)
+                self._written_updated.pop(tuple(key), None)
+        with self.lock:
+            self.entries = { key: entry for key, entry in self.entries.items() if not (entry.stale and entry.updated < limit) }
+        if expired:
+            self.log(logging.INFO, f'Removed inventory snapshot of {len(expired)} user(s) older than {self.max_age} seconds')
+
+    def sync(self, endpoint, user, api, incremental=False, tasks_api=None):
+        """Retrieve the complete inventory (and, to be able to follow the task log afterwards, the tasks reflected in it)
+        tasks_api: API instance to read the task log with (e.g. using service credentials seeing the tasks of all users; default: api)"""
+        # Read the tasks first: tasks finishing in between are then considered again during the next incremental update
+        done = finished_tasks((tasks_api or api).get_cluster_tasks()) if incremental else None
+        machines = api.get_virtual_machines()
+        self.put(endpoint, user, machines, done=done)
+        return machines
+
+    def update(self, endpoint, user, api, entry, tasks_api=None):
+        """Apply the changes indicated by the tasks since the last update to the inventory; returns False if a full resync is needed
+        Note: Changes without a task (e.g. a shutdown inside the guest) and, when reading the task log with the user's own credentials,
+        tasks of other users are missed; they show up with the next complete retrieval after resync_interval"""
+        tasks = (tasks_api or api).get_cluster_tasks()
+        upids = { task['upid'] for task in tasks }
+        if entry.done and not (entry.done & upids):
+            return False # gap: none of the tasks seen before is listed anymore, so further tasks may have been missed
+        vmids = set()
+        for task in tasks:
+            if task['upid'] in entry.done:
+                continue
+            if task.get('type') in resync_task_types:
+                return False
+            if (task.get('type') in status_task_types) and task.get('id'):
+                vmids.add(str(task['id']))
+        machines = dict(entry.machines)
+        for key, item in entry.machines.items():
+            if str(item['vmid']) in vmids:
+                data = api.get_virtual_machines(node=item['node'], vmid=item['vmid'], vmtype=item['type'])
+                if data is None:
+                    return False # guest vanished or no longer permitted
+                machines[key] = dict(item, **data) # keep data only listed for the cluster, e.g. tags and pool
+        if vmids:
+            self.put(endpoint, user, machines, synced=entry.synced, done=finished_tasks(tasks))
+        else:
+            with self.lock:
+                entry.done = finished_tasks(tasks)
+        return True
+
+    def refresh_in_background(self, endpoint, user, api, incremental=False, tasks_api=None):
+        """Retrieve the complete inventory in a background thread (at most one refresh per endpoint and user at a time)"""
+        key = (endpoint, user)
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        def run():
+            try:
+                self.sync(endpoint, user, api, incremental, tasks_api)
+            except Exception as e:
+                self.log(logging.WARNING, f'Could not refresh inventory of user [{user}] at [{endpoint}]: {str(e)}')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+        threading.Thread(target=run, name='Inventory refresh', daemon=True).start()
+
+    def get_machines(self, endpoint, user, api, incremental=False, tasks_api=None):
+        """Return the machine list and, if it is stale, the time of its retrieval (otherwise None)
+        Stale data from the snapshot file is returned immediately while being refreshed in the background; otherwise the known list
+        is updated following the task log (if incremental and the last complete retrieval is recent enough) or retrieved completely"""
+        entry = self.get(endpoint, user)
+        if (entry is not None) and entry.stale:
+            self.refresh_in_background(endpoint, user, api, incremental, tasks_api)
+            return entry.machines, entry.updated
+        incremental = incremental and (self.resync_interval > 0)
+        if incremental and (entry is not None) and (entry.done is not None) and (time.time() - entry.synced < self.resync_interval):
+            try:
+                if self.update(endpoint, user, api, entry, tasks_api):
+                    return self.get(endpoint, user).machines, None
+            except Exception as e:
+                self.log(logging.DEBUG, f'Incremental inventory update for user [{user}] at [{endpoint}] failed: {str(e)}')
+        return self.sync(endpoint, user, api, incremental, tasks_api), None
+
+    def get_stale_machine(self, endpoint, user, id):
+        """Return the data of the given machine and the time of its retrieval if only stale data of the given endpoint and user is known so far
+        (otherwise None, None)"""
+        entry = self.get(endpoint, user)
+        if (entry is not None) and entry.stale:
+            for item in entry.machines.values():
+                if item.get('id') == id:
+                    return dict(item), entry.updated
+        return None, None
@@ -3,22 +3,79 @@
 # Notes:
 # - Tags: useful as meta information for e.g., provisioning or config management systems, see https://lists.proxmox.com/pipermail/pve-devel/2019-October/039967.html
 
+import concurrent.futures
 import datetime
+import random
+import re
+import threading
+import time
 
 from . import proxapi
+from . import sparkline
+
+
+def parse_tags(tags):
+    """Convert the tag string of a virtual machine (e.g. 'myprox_expiry.2025-12-31;other') to a dictionary"""
+    if tags is None:
+        tags = ''
+    # Proxmox accepts ';', ',' and spaces as separators (the cluster resource list uses ';')
+    tags = [ tag.partition('.') for tag in re.split('[;, ]', tags) if tag.strip() ]
+    tags = { key.strip(): value.strip() for key, _, value in tags }
+    return tags
+
+def format_tags(tags):
+    """Convert a tag dictionary to the tag string of a virtual machine (inverse of parse_tags; tags without value are written as plain key)"""
+    return ';'.join([ key if (value is None) or (len(value) == 0) else f'{key}.{value}' for key, value in tags.items() ])
+
+def apply_tag_changes(tags, changes):
+    """Return a copy of the tag dictionary with the changes (dictionary of tag to new value; None removes the tag) applied"""
+    tags = dict(tags)
+    for tag, value in changes.items():
+        if value is None:
+            tags.pop(tag, None)
+        else:
+            tags[tag] = value
+    return tags
+
+def is_config_conflict(e):
+    """Check whether the exception reports a configuration modified concurrently (digest mismatch)"""
+    import proxmoxer # imported on demand to speed up startup
+    return isinstance(e, proxmoxer.core.ResourceException) and ('modified configuration' in str(e))
+
+def parse_expiry(tags):
+    """Return the expiry date from a tag dictionary (None if not set or invalid)"""
+    expiry = tags.get('myprox_expiry')
+    if expiry is not None:
+        try:
+            expiry = datetime.date.fromisoformat(expiry)
+        except ValueError:
+            expiry = None
+    return expiry
+
+def connect_service(cfg, node):
+    """Connect to the Proxmox API of the given node using the configured service credentials (see "sweeper_user")"""
+    return MyProxAPI(cfg.proxmox_api(node), cfg.sweeper_user(node), cfg.sweeper_password(node), verify_ssl=cfg.proxmox_api_verifyssl(node),
+                     token_name=cfg.sweeper_token_name(node), token_value=cfg.sweeper_token_value(node), upstream_limit=cfg.upstream_concurrency(node))
 
 
 class MyProxAPI(proxapi.ProxAPI):
 
-    def __init__(self, host, user, password=None, ticket=None, verify_ssl=True):
+    def __init__(self, host, user, password=None, ticket=None, verify_ssl=True, token_name=None, token_value=None, permissions_ttl=300, usage_ttl=60, upstream_limit=8):
         """Instance initialization"""
-        super().__init__(host, user, password=password, ticket=ticket, verify_ssl=verify_ssl)
+        super().__init__(host, user, password=password, ticket=ticket, verify_ssl=verify_ssl, token_name=token_name, token_value=token_value, upstream_limit=upstream_limit)
+        self._cache_lock = threading.Lock() # the caches are shared by concurrent requests of the session
         self.clear_tag_cache()
+        self.permissions_ttl = permissions_ttl
+        self.permissions_failure_ttl = min(30, permissions_ttl) # don't retry failing permission requests on every check
+        self._guest_pools = dict() # vmid -> pool (None if not in a pool) as seen in the cluster resource list
+        self.clear_permission_cache()
+        self.usage_ttl = usage_ttl
+        self._cache_usage = dict()
 
     def check_role_VMUserMyProx(self):
         """Check whether the role 'PVEVMUserMyProx' has the required permissions"""
         role = 'PVEVMUserMyProx'
-        result = get_role(role)
+        result = self.get_role(role)
         if not result:
             # See https://pve.proxmox.com/pve-docs/chapter-pveum.html#_privileges
             raise Exception(f'Proxmox role {role} does not yet exist. Please create it under "Datacenter"|"Permissions"|"Roles" and assign (at least) permissions "VM.Console", "VM.PowerMgmt", and "VM.Audit" to it.')
@@ -29,50 +86,133 @@ class MyProxAPI(proxapi.ProxAPI):
         if result.get('VM.Audit', 0) != 1: # needed to read basic information
             raise Exception(f'Proxmox role {role} needs to have "VM.Audit" permission assigned to it.')
 
+    def clear_permission_cache(self):
+        """Clears the permission cache"""
+        with self._cache_lock:
+            self._cache_permissions = None # (time of retrieval, permissions)
+
+    def get_permissions(self):
+        """Get the effective permissions of the user (dictionary path -> privileges) using the permission cache
+        Returns None if they can't be retrieved (this is cached as well, for permissions_failure_ttl seconds)"""
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache_permissions
+        if cached is not None:
+            ttl = self.permissions_ttl if (cached[1] is not None) else self.permissions_failure_ttl
+            if now - cached[0] < ttl:
+                return cached[1]
+        try:
+            permissions = self.proxmox.access.permissions.get()
+        except Exception:
+            permissions = None
+        with self._cache_lock:
+            self._cache_permissions = (now, permissions)
+        return permissions
+
+    def get_cluster_resources(self, type=None):
+        """Return the cluster-wide resource list (see ProxAPI) and remember the pool membership of the guests listed"""
+        resources = super().get_cluster_resources(type=type)
+        pools = { str(item['vmid']): item.get('pool') for item in resources if item.get('type') in proxapi.guest_types }
+        with self._cache_lock:
+            self._guest_pools.update(pools)
+        return resources
+
+    def has_permission(self, privilege, vmid=None, pool=None):
+        """Check whether the user has the given privilege on a virtual machine (no API call as long as the permission cache is valid)
+        pool: the machine's pool (default: as seen in the last cluster resource list)"""
+        # Note: This is only used to hide actions; Proxmox still checks permissions on each request
+        # Note: /access/permissions maps each privilege to its "propagate" flag; a privilege listed for the machine's own path is
+        # granted either way, while one listed for a parent path (e.g. '/vms' or a pool) only applies if it is propagated
+        permissions = self.get_permissions()
+        if permissions is None:
+            return True # can't tell; let Proxmox decide
+        if (vmid is not None) and (privilege in permissions.get(f'/vms/{vmid}', dict())):
+            return True
+        paths = ['/', '/vms']
+        known = pool is not None
+        if (not known) and (vmid is not None):
+            with self._cache_lock:
+                known = str(vmid) in self._guest_pools
+                pool = self._guest_pools.get(str(vmid))
+        if pool:
+            paths.append(f'/pool/{pool}')
+        elif not known:
+            # Pool membership unknown: any pool granting the privilege may contain the machine
+            paths.extend([ path for path in permissions.keys() if path.startswith('/pool/') ])
+        return any([ permissions.get(path, dict()).get(privilege) == 1 for path in paths ])
+
     def clear_tag_cache(self):
         """Clears the tag cache"""
-        self._cache_id = None
-        self._cache_tags = None
+        with self._cache_lock:
+            self._cache_tags = None # (machine id, tags)
 
     def get_tags_direct(self, id):
         """Get a dictionary of all the tags assigned to a given virtual machine"""
         # Requires: ["perm","/vms/{vmid}",["VM.Audit"]]
-        vmid, node = self.decompose_id(id)
-        tags = self.proxmox.nodes(node).qemu(vmid).config.get().get('tags')
-        if tags is None:
-            tags = ''
-        tags = tags.split(',')
-        tags = [ tag.partition('.') for tag in tags ]
-        tags = { key.strip(): value.strip() for key, _, value in tags }
-        return tags        
+        tags = self.guest(id).config.get().get('tags')
+        return parse_tags(tags)
 
     def get_tags(self, id):
         """Get a dictionary of all the tags assigned to a given virtual machine using tag cache"""
-        if (self._cache_id is None) or (self._cache_tags is None) or (self._cache_id != id):
-            self._cache_tags = self.get_tags_direct(id)
-            self._cache_id = id
-        return self._cache_tags 
+        with self._cache_lock:
+            cached = self._cache_tags
+        if (cached is not None) and (cached[0] == id):
+            return cached[1]
+        tags = self.get_tags_direct(id)
+        with self._cache_lock:
+            self._cache_tags = (id, tags)
+        return tags
 
     def set_tags(self, id, tags):
         """Overwrite the tags of a given virtual machine based on a dictionary of all the new tags"""
         # Requires permission: (/vms/{vmid}, VM.Config.Options)
-        vmid, node = self.decompose_id(id)
-        # Convert dict to string representation
-        tags = [ {key} if (value is None) or (len(value) == 0) else f'{key}.{value}' for key, value in tags.items() ]
-        tags = ', '.join(tags)
-        self.proxmox.nodes(node).qemu(vmid).config.put(tags=tags)
+        self.guest(id).config.put(tags=format_tags(tags))
+        self.clear_tag_cache()
+
+    def update_tags(self, id, changes, retries=5):
+        """Apply several tag changes (dictionary of tag to new value; None removes the tag) to a given virtual machine with a single write
+        The write passes the digest of the configuration read before, so concurrent changes by others are not lost but lead to a retry
+        Returns whether the tags had to be changed at all"""
+        # Requires permission: (/vms/{vmid}, VM.Config.Options)
+        import proxmoxer # imported on demand to speed up startup
+        self.clear_tag_cache()
+        for attempt in range(retries + 1):
+            config = self.guest(id).config.get()
+            tags = parse_tags(config.get('tags'))
+            new_tags = apply_tag_changes(tags, changes)
+            if new_tags == tags:
+                return False
+            try:
+                self.guest(id).config.put(tags=format_tags(new_tags), digest=config.get('digest'))
+                return True
+            except proxmoxer.core.ResourceException as e:
+                if not is_config_conflict(e) or (attempt == retries):
+                    raise
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt)) # let the concurrent writer finish (jittered to avoid colliding again)
+
+    def update_tags_many(self, changes, max_workers=4):
+        """Apply tag changes (dictionary of machine id to tag changes, see update_tags) to many virtual machines with bounded parallelism
+        Returns dictionaries of results and of errors (exceptions) per machine id"""
+        results = dict()
+        errors = dict()
+        if not changes:
+            return results, errors
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = { executor.submit(self.update_tags, id, id_changes): id for id, id_changes in changes.items() }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+        return results, errors
 
     def ensure_tag_set(self, id, tag, value):
         """Make sure that the tags of a given virtual machine has the specified one set to a desired value"""
-        tags = self.get_tags(id)
-        tags[tag] = value
-        return self.set_tags(id, tags)
+        return self.update_tags(id, {tag: value if value is not None else ''})
         
     def ensure_tag_unset(self, id, tag):
         """Make sure that the tags of a given virtual machine don't include the specified one"""
-        tags = self.get_tags(id)
-        tags.pop(tag, None)
-        return self.set_tags(id, tags)
+        return self.update_tags(id, {tag: None})
 
     def get_tag_expiry(self, id):
         """Returns the value of the expiry tag"""
@@ -91,6 +231,10 @@ class MyProxAPI(proxapi.ProxAPI):
         newdate = datetime.date.today()+datetime.timedelta(days=days)
         return self.set_tag_expiry(id, newdate)
 
+    def set_tag_expiry_many(self, ids, newdate, max_workers=4):
+        """Sets the value of the expiry tag of many virtual machines; returns dictionaries of results and of errors per machine id"""
+        return self.update_tags_many({ id: {'myprox_expiry': newdate.isoformat()} for id in ids }, max_workers=max_workers)
+
     def get_virtual_machine_with_tags(self, id):
         """Return the data of the given virtual machine (id format: 'vmid@node') incl. certain tags"""
         data = self.get_virtual_machine(id)
@@ -98,3 +242,38 @@ class MyProxAPI(proxapi.ProxAPI):
             self.clear_tag_cache()
             data['tag_expiry'] = self.get_tag_expiry(id)
         return data
+
+    def get_usage_history(self, id, timeframe='hour', points=60):
+        """Return downsampled usage series of the given guest (CPU/memory in percent, network/disk in bytes per second) using the usage cache"""
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache_usage.get((id, timeframe))
+        if (cached is not None) and (now - cached[0] < self.usage_ttl):
+            return cached[1]
+        rows = [ row if row.get('cpu') is not None else None for row in self.get_rrddata(id, timeframe) ] # rows without data mark gaps
+        def series(func):
+            return sparkline.downsample([ None if row is None else func(row) for row in rows ], points)
+        result = {
+            'cpu': series(lambda row: 100 * row['cpu']),
+            'mem': series(lambda row: 100 * row.get('mem', 0) / row['maxmem'] if row.get('maxmem') else 0),
+            'net': series(lambda row: row.get('netin', 0) + row.get('netout', 0)),
+            'disk': series(lambda row: row.get('diskread', 0) + row.get('diskwrite', 0)),
+        }
+        # Drop expired entries so that the cache doesn't grow while browsing many machines
+        with self._cache_lock:
+            self._cache_usage = { key: value for key, value in self._cache_usage.items() if now - value[0] < self.usage_ttl }
+            self._cache_usage[(id, timeframe)] = (now, result)
+        return result
+
+    def get_expiry_tags(self):
+        """Return the expiry dates of all accessible virtual machines and containers from the cluster resource list (single API call)"""
+        result = dict()
+        for vm in self.get_cluster_resources(type='vm'):
+            if vm.get('type') not in proxapi.guest_types:
+                continue
+            if vm.get('template'): # templates don't run and thus don't expire
+                continue
+            item = vm.copy()
+            item['tag_expiry'] = parse_expiry(parse_tags(vm.get('tags')))
+            result[self.compose_id(vm['type'], vm['vmid'], vm['node'])] = item
+        return result
@@ -3,123 +3,35 @@
 # ProxmoxAPI documentation: see https://pve.proxmox.com/pve-docs/api-viewer/
 
 import importlib
-import proxmoxer
-from proxmoxer import SERVICES
+import time
 
+from . import upstream
 
-def ProxmoxHTTPAuth_init(self, username, password, otp=None, base_url="", otptype="totp", ticket=None, **kwargs):
-    """Patched ProxmoxHTTPAuth.__init__, see original at https://github.com/proxmoxer/proxmoxer/blob/develop/proxmoxer/backends/https.py"""
-    # Replace super().__init__(...)
-    backend_https = importlib.import_module(f'.backends.https', 'proxmoxer')
-    backend_https.ProxmoxHTTPAuthBase.__init__(self, **kwargs)
 
-    self.base_url = base_url
-    self.username = username
-    # Use ticket if available
-    self.pve_auth_ticket = ticket if (ticket is not None) else ""
+_ticketapi = None
 
-    self._get_new_tokens(password=password, otp=otp)
+# Guest types: QEMU virtual machines and LXC containers
+guest_types = ['qemu', 'lxc']
 
-def Backend_init(
-    self,
-    host,
-    user=None,
-    password=None,
-    ticket=None,
-    otp=None,
-    port=None,
-    verify_ssl=True,
-    mode="json",
-    timeout=5,
-    token_name=None,
-    token_value=None,
-    path_prefix=None,
-    service="PVE",
-    cert=None,
-    proxies=None,
-):
-    """Patched Backends.__init__, see original file at https://github.com/proxmoxer/proxmoxer/blob/develop/proxmoxer/backends/https.py"""
-    # Notes:
-    # The only changes are:
-    # - adding and passing on "ticket" keyword parameter
-    # - allowing password==None if ticket is provided
-
-    # Make relevant variables available
-    backend_https = importlib.import_module(f'.backends.https', 'proxmoxer')
-    ProxmoxHTTPAuth = backend_https.ProxmoxHTTPAuth
-    ProxmoxHTTPApiTokenAuth = backend_https.ProxmoxHTTPApiTokenAuth
-    config_failure = backend_https.config_failure
-
-    self.proxies = proxies
-    self.cert = cert
-    host_port = ""
-    if len(host.split(":")) > 2:  # IPv6
-        if host.startswith("["):
-            if "]:" in host:
-                host, host_port = host.rsplit(":", 1)
-        else:
-            host = f"[{host}]"
-    elif ":" in host:
-        host, host_port = host.split(":")
-    port = host_port if host_port.isdigit() else port
-
-    # if a port is not specified, use the default port for this service
-    if not port:
-        port = SERVICES[service]["default_port"]
-
-    self.mode = mode
-    if path_prefix is not None:
-        self.base_url = f"https://{host}:{port}/{path_prefix}/api2/{mode}"
-    else:
-        self.base_url = f"https://{host}:{port}/api2/{mode}"
-
-    if token_name is not None:
-        if "token" not in SERVICES[service]["supported_https_auths"]:
-            config_failure("{} does not support API Token authentication", service)
-
-        self.auth = ProxmoxHTTPApiTokenAuth(
-            user,
-            token_name,
-            token_value,
-            verify_ssl=verify_ssl,
-            timeout=timeout,
-            service=service,
-            cert=self.cert,
-            proxies=proxies,
-        )
-    # The following line got changed
-    elif (password is not None) or (ticket is not None):
-        if "password" not in SERVICES[service]["supported_https_auths"]:
-            config_failure("{} does not support password authentication", service)
-
-        self.auth = ProxmoxHTTPAuth(
-            user,
-            password,
-            otp,
-            base_url=self.base_url,
-            # The following line got changed
-            ticket=ticket,
-            verify_ssl=verify_ssl,
-            timeout=timeout,
-            service=service,
-            cert=self.cert,
-            proxies=proxies,
-        )
-    else:
-        config_failure("No valid authentication credentials were supplied")
 
+def install_ticket_support():
+    """Import the ticket-enabled proxmoxer subclasses once (this imports 'requests'; call at startup to keep the first login fast)"""
+    global _ticketapi
+    if _ticketapi is None:
+        _ticketapi = importlib.import_module('.ticketapi', __package__)
+    return _ticketapi
 
 
 class ProxAPI():
 
-    def __init__(self, host, user, password=None, ticket=None, verify_ssl=True):
+    def __init__(self, host, user, password=None, ticket=None, verify_ssl=True, token_name=None, token_value=None, upstream_limit=8):
         """Object initialization: set API parameters"""
-        # Monkey-patch "proxmoxer" library to support tickets instead of passwords
-        backend = importlib.import_module(f'.backends.https', 'proxmoxer')
-        backend.ProxmoxHTTPAuth.__init__ = ProxmoxHTTPAuth_init
-        backend.Backend.__init__ = Backend_init
-        # Create proxmoxer instance
-        self.proxmox = proxmoxer.ProxmoxAPI(host, user=user, password=password, ticket=ticket, verify_ssl=verify_ssl)
+        # Create proxmoxer instance (supporting tickets instead of passwords)
+        self.proxmox = install_ticket_support().TicketProxmoxAPI(host, user=user, password=password, ticket=ticket, verify_ssl=verify_ssl, token_name=token_name, token_value=token_value)
+        # Coalesce identical concurrent read calls of this user and limit the number of concurrent calls to this host
+        # (the session is shared by all resources derived from the proxmoxer instance)
+        self.upstream = upstream.GuardedSession(self.proxmox._store['session'], host, (user, token_name), upstream_limit)
+        self.proxmox._store['session'] = self.upstream
 
     def int2human(self, value, decimal_places = -1):
         """Convert integer value to human readable one with 'K'/'M'/'G'/'T'"""
@@ -163,18 +75,47 @@ class ProxAPI():
         return f'{value:{format}} {unit}'
     
     def decompose_id(self, id):
-        """Returns the vmid and node part of the provided id (format: 'vmid@node')"""
+        """Returns the vmid and node part of the provided id (format: '[type/]vmid@node')"""
+        vmtype, vmid, node = self.decompose_guest_id(id)
+        return vmid, node
+
+    def decompose_guest_id(self, id):
+        """Returns the guest type, vmid and node part of the provided id (format: '[type/]vmid@node' with type 'qemu' (default) or 'lxc')"""
         if id is None:
             raise ValueError('No vmid provided')
+        vmtype, _, id = id.rpartition('/')
+        if not vmtype:
+            vmtype = 'qemu'
+        if vmtype not in guest_types:
+            raise ValueError('invalid guest type')
         vmid, _, node = id.partition('@')
         if (node is not None) and (not len(node)):
             node = None
         if not vmid.isdecimal():
             raise ValueError('vmid must be numeric')
-        return vmid, node
+        return vmtype, vmid, node
+
+    def compose_id(self, vmtype, vmid, node):
+        """Returns the id of a guest (format: '[type/]vmid@node'; the type is omitted for QEMU VMs)"""
+        prefix = '' if vmtype == 'qemu' else f'{vmtype}/'
+        return f'{prefix}{vmid}@{node}'
+
+    def guest(self, id):
+        """Returns the API resource of the given guest, e.g. for 'lxc/105@pve1' the one of '/nodes/pve1/lxc/105'"""
+        vmtype, vmid, node = self.decompose_guest_id(id)
+        return self.proxmox.nodes(node)(vmtype)(vmid)
+
+    def is_available(self):
+        """Whether the Proxmox API is currently considered reachable (see upstream circuit breaker)"""
+        return not self.upstream.limit.is_open()
+
+    def api_for(self, id):
+        """Returns the API instance responsible for the given guest (overridden in federated mode)"""
+        return self
     
     def get_role(self, role):
         """Gets data regarding the specified role"""
+        import proxmoxer # imported on demand to speed up startup
         try:
             # all roles: proxmox.access.roles.get()
             # single role: proxmox.access.roles(role).get())
@@ -189,52 +130,80 @@ class ProxAPI():
     def get_nodes(self):
         return self.proxmox.nodes.get()
 
-    def get_virtual_machines(self, node=None, vmid=None, full=False):
-        """Return the data of the available virtual machines (or filter to return data of VMs on single node or just the data of a single VM)"""
+    def get_cluster_resources(self, type=None):
+        """Return the cluster-wide resource list (optionally filtered by type, e.g. 'vm') in a single API call"""
+        # Requires: only lists resources the user has "*.Audit" permission on
+        return self.proxmox.cluster.resources.get(type=type)
+
+    def add_human_readable_data(self, vm, vmtype, node):
+        """Return a copy of the given guest data with node, type, id and human readable values added"""
+        item = vm.copy() #item = { key: value for key, value in vm.items() }
+        item['node'] = node
+        item['type'] = vmtype
+        item['id'] = self.compose_id(vmtype, vm['vmid'], node)
+        if 'cpus' not in item: # the cluster resource list provides "maxcpu" instead
+            item['cpus'] = vm.get('maxcpu')
+        item['mem_human'] = self.int2human(vm.get('mem', 0))
+        item['maxmem_human'] = self.int2human(vm.get('maxmem', 0))
+        if (item['mem_human'] == item['maxmem_human']) or (vm.get('mem', 0) == 0):
+            item['memrange'] = item['maxmem_human']
+        else:
+            item['memrange'] = item['mem_human'] + ' of ' + item['maxmem_human']
+        item['maxdisk_human'] = self.int2human(vm.get('maxdisk', 0))
+        item['uptime_human'] = self.uptime2human(vm.get('uptime', 0))
+        if item['status'] == 'running':
+            item['status_uptime'] = item['status'] + ' for ' + item['uptime_human']
+        elif item['status'] == 'stopped':
+            item['status_uptime'] = item['status']
+        else:
+            item['status_uptime'] = item['status'] + ', up for ' + item['uptime_human']
+        return item
+
+    def get_virtual_machines(self, node=None, vmid=None, vmtype=None):
+        """Return the data of the available virtual machines and containers (or filter to return data of guests on single node or just the data of a single guest)"""
         result = dict()
-        for current_node in ([{'node': node}] if node is not None else self.proxmox.nodes.get()):
-            if current_node.get('status', 'online') != 'online': # one can't query non-online nodes
-                continue
-            # Works similarly for LXC:
-            # for vm in self.proxmox.nodes(current_node["node"]).lxc.get():
-            #     print("{0}: {1} => {2}".format(vm["vmid"], vm["name"], vm["status"]))
-            #     print('Uptime:', uptime2human(vm['uptime']))
-            for vm in self.proxmox.nodes(current_node['node']).qemu.get(full=(1 if full else 0)):
-                item = vm.copy() #item = { key: value for key, value in vm.items() }
-                item['node'] = current_node['node']
-                item['mem_human'] = self.int2human(vm['mem'])
-                item['maxmem_human'] = self.int2human(vm['maxmem'])
-                if (item['mem_human'] == item['maxmem_human']) or (vm['mem'] == 0):
-                    item['memrange'] = item['maxmem_human']
-                else:
-                    item['memrange'] = item['mem_human'] + ' of ' + item['maxmem_human']
-                item['maxdisk_human'] = self.int2human(vm['maxdisk'])
-                item['uptime_human'] = self.uptime2human(vm['uptime'])
-                if item['status'] == 'running':
-                    item['status_uptime'] = item['status'] + ' for ' + item['uptime_human']
-                elif item['status'] == 'stopped':
-                    item['status_uptime'] = item['status']
-                else:
-                    item['status_uptime'] = item['status'] + ', up for ' + item['uptime_human']
-                result[vm['vmid']] = item
+        if (vmid is not None) and not str(vmid).isdecimal():
+            return None
+        if (vmid is not None) and (node is not None):
+            # Fast path for a single guest
+            import proxmoxer # imported on demand to speed up startup
+            vmtype = vmtype or 'qemu'
+            try:
+                vm = self.proxmox.nodes(node)(vmtype)(vmid).status.current.get()
+            except proxmoxer.core.ResourceException:
+                return None # guest does not exist or no permission
+            vm['vmid'] = int(vmid)
+            return self.add_human_readable_data(vm, vmtype, node)
+        # Get VMs and containers of all nodes in a single API call
+        for item in self.iter_virtual_machines():
+            if (node is None) or (item['node'] == node):
+                result[item['vmid']] = item
         if (vmid is not None):
-            if str(vmid).isdecimal():
-                return result.get(int(vmid))
-            else:
-                return None
+            return result.get(int(vmid))
         return result            
 
-    def get_virtual_machine(self, id, full=False):
-        """Return the data of the given virtual machine (id format: 'vmid@node')"""
-        vmid, node = self.decompose_id(id)
-        result = self.get_virtual_machines(node=node, vmid=vmid, full=full)
+    def iter_virtual_machines(self):
+        """Yield the data of the available virtual machines and containers one by one from the cluster resource list (single API call;
+        the same data as listed by get_virtual_machines)"""
+        for vm in self.get_cluster_resources(type='vm'):
+            if vm.get('type') not in guest_types:
+                continue
+            if vm.get('status') == 'unknown': # guest on a non-online node
+                continue
+            yield self.add_human_readable_data(vm, vm['type'], vm['node'])
+
+    def get_virtual_machine(self, id):
+        """Return the data of the given virtual machine or container (id format: '[type/]vmid@node')"""
+        vmtype, vmid, node = self.decompose_guest_id(id)
+        result = self.get_virtual_machines(node=node, vmid=vmid, vmtype=vmtype)
         return result
 
     def get_spice(self, id):
         """Gets the content of a SPICE connection file"""
         vmid, node = self.decompose_id(id)        
+        import proxmoxer # imported on demand to speed up startup
         try:
-            result = self.proxmox.nodes(node).qemu(vmid).spiceproxy.post()
+            result = self.guest(id).spiceproxy.post()
         except proxmoxer.core.ResourceException as e:
             err = str(e)
             if 'not running' in err:
@@ -246,19 +215,58 @@ class ProxAPI():
         return result
 
     def trigger_vm_action(self, id, action):
-        """Triggers an action (status change) on the given VM"""
+        """Triggers an action (status change) on the given VM or container; returns the UPID of the Proxmox task"""
+        vmtype, vmid, node = self.decompose_guest_id(id)
+        if (vmtype == 'lxc') and (action == 'reset'):
+            raise ValueError('Containers cannot be reset')
+        if action in ['start', 'reboot', 'shutdown', 'reset', 'stop', 'suspend', 'resume']:
+            return self.guest(id).status(action).post()
+        return None
+
+    def get_vm_status(self, id):
+        """Return the current status data of the given VM or container (single API call)"""
+        return self.guest(id).status.current.get()
+
+    def power_state(self, status):
+        """Return the power state ('running', 'stopped', 'paused', 'suspended' etc.) from the status data of a guest
+        (for QEMU VMs paused or suspended to RAM, the status stays 'running' while 'qmpstatus' tells the actual state)"""
+        return status.get('qmpstatus') or status.get('status')
+
+    def get_rrddata(self, id, timeframe='hour', cf='AVERAGE'):
+        """Return the resource usage history of the given VM or container (timeframe: 'hour', 'day', 'week', 'month' or 'year')"""
+        return self.guest(id).rrddata.get(timeframe=timeframe, cf=cf)
+
+    def get_cluster_identity(self):
+        """Return a value identifying the cluster (or single node) behind this API: the cluster name and its nodes with their addresses"""
+        status = self.proxmox.cluster.status.get()
+        names = [ item.get('name') for item in status if item.get('type') == 'cluster' ]
+        nodes = frozenset([ (item.get('name'), item.get('ip')) for item in status if item.get('type') == 'node' ])
+        return (names[0] if names else None, nodes)
+
+    def get_cluster_tasks(self):
+        """Return the recent tasks of the cluster (only the user's own tasks unless having "Sys.Audit" permission)"""
+        return self.proxmox.cluster.tasks.get()
+
+    def get_task_status(self, node, upid):
+        """Return the status of the given Proxmox task"""
+        return self.proxmox.nodes(node).tasks(upid).status.get()
+
+    def wait_until_running(self, id, upid=None, timeout=60):
+        """Wait (polling with backoff) until the start task with the given UPID has finished or, without UPID, until the VM is running"""
         vmid, node = self.decompose_id(id)
-        if action == 'start':
-            self.proxmox.nodes(node).qemu(vmid).status.start.post()
-        elif action == 'reboot':
-            self.proxmox.nodes(node).qemu(vmid).status.reboot.post()
-        elif action == 'shutdown':
-            self.proxmox.nodes(node).qemu(vmid).status.shutdown.post()
-        elif action == 'reset':
-            self.proxmox.nodes(node).qemu(vmid).status.reset.post()
-        elif action == 'stop':
-            self.proxmox.nodes(node).qemu(vmid).status.stop.post()
-        elif action == 'suspend':
-            self.proxmox.nodes(node).qemu(vmid).status.suspend.post()
-        elif action == 'resume':
-            self.proxmox.nodes(node).qemu(vmid).status.resume.post()
+        deadline = time.monotonic() + timeout
+        delay = 0.5
+        while True:
+            if upid is not None:
+                task = self.get_task_status(node, upid)
+                if task.get('status') == 'stopped':
+                    if task.get('exitstatus') != 'OK':
+                        raise Exception(f'Starting VM {vmid} on {node} failed [{task.get("exitstatus")}]')
+                    return True
+            elif self.power_state(self.get_vm_status(id)) == 'running':
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f'VM {vmid} on {node} did not start within {timeout} seconds')
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 4)
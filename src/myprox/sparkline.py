@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+# Server-side rendering of resource usage history as inline SVG sparklines (no JavaScript needed)
+
+
+def downsample(values, points):
+    """Reduce the given series to (at most) the given number of points by averaging buckets; None marks gaps"""
+    if len(values) <= points:
+        return list(values)
+    result = []
+    for i in range(points):
+        bucket = [ value for value in values[i * len(values) // points:(i + 1) * len(values) // points] if value is not None ]
+        result.append(sum(bucket) / len(bucket) if bucket else None)
+    return result
+
+def render_svg(values, maximum=None, width=150, height=30):
+    """Render the given series as inline SVG sparkline; the y-axis spans from zero to maximum (default: largest value)"""
+    if maximum is None:
+        maximum = max([ value for value in values if value is not None ], default=0)
+    if not maximum:
+        maximum = 1
+    step = width / max(len(values) - 1, 1)
+    commands = []
+    pen_down = False
+    for i, value in enumerate(values):
+        if value is None: # gap in data
+            pen_down = False
+            continue
+        x = round(i * step, 1)
+        y = round(height - 1 - min(value / maximum, 1) * (height - 2), 1)
+        commands.append(f'{"L" if pen_down else "M"}{x},{y}')
+        pen_down = True
+    return (f'<svg class="sparkline" width="{width}" height="{height}" viewBox="0 0 {width} {height}" role="img">'
+            f'<path d="{" ".join(commands)}"/></svg>')
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# Background sweeper acting on the "myprox_expiry" tag of virtual machines
+
+import cherrypy
+import csv
+import datetime
+import json
+import logging
+import os
+import random
+import threading
+
+from . import myproxapi
+
+
+report_fields = ['id', 'vmid', 'node', 'name', 'status', 'expiry', 'state', 'new', 'action']
+
+
+class ExpirySweeper():
+    """Periodically checks the expiry tags of all machines of a node/cluster and reports or acts on expiring and expired ones"""
+
+    def __init__(self, cfg, node, audit_log=None):
+        """Instance initialization"""
+        self.cfg = cfg
+        self.node = node
+        self.audit_log = audit_log
+        self.api = None
+        self.expiring = set() # ids of machines found expiring soon in the last run
+        self.expired = set() # ids of machines found expired in the last run
+        self.acted = set() # ids of expired machines the configured action has already been applied to
+        self._stop_event = threading.Event()
+        self._first_run = True
+
+    def connect(self):
+        """Connect to the Proxmox API using the service credentials (reusing an existing connection)"""
+        if self.api is None:
+            self.api = myproxapi.connect_service(self.cfg, self.node)
+        return self.api
+
+    def log(self, severity, message):
+        """Log a message of the sweeper"""
+        cherrypy.log(f'Expiry sweeper for node [{self.node}]: {message}', context='SWEEPER', severity=severity, traceback=False)
+
+    def stop(self):
+        """Interrupt a running sweep (e.g. on engine stop)"""
+        self._stop_event.set()
+
+    def classify(self, vms, today=None):
+        """Split the given machines into the ones expiring soon and the already expired ones"""
+        if today is None:
+            today = datetime.date.today()
+        warn_date = today + datetime.timedelta(days=self.cfg.sweeper_warn_days(self.node))
+        expiring = dict()
+        expired = dict()
+        for id, vm in vms.items():
+            expiry = vm.get('tag_expiry')
+            if expiry is None:
+                continue
+            if expiry < today:
+                expired[id] = vm
+            elif expiry <= warn_date:
+                expiring[id] = vm
+        return expiring, expired
+
+    def sweep(self):
+        """Do a single sweep; this is called periodically from a background thread"""
+        if self._first_run:
+            self._first_run = False
+            # Don't let sweepers of several nodes hit their APIs at the same time
+            if self._stop_event.wait(random.uniform(0, min(60, self.cfg.sweeper_interval(self.node)))):
+                return
+        try:
+            vms = self.connect().get_expiry_tags()
+        except Exception as e:
+            self.log(logging.WARNING, f'could not list machines: {str(e)}')
+            self.api = None # reconnect on next run (e.g. in case the ticket expired)
+            return
+        expiring, expired = self.classify(vms)
+        # Compute changes since last run
+        new_expiring = expiring.keys() - self.expiring
+        new_expired = expired.keys() - self.expired
+        self.expiring = set(expiring.keys())
+        self.expired = set(expired.keys())
+        self.acted &= self.expired # forget machines that got extended or deleted
+        self.log(logging.INFO, f'{len(expiring)} machines expiring soon ({len(new_expiring)} new), {len(expired)} expired ({len(new_expired)} new)')
+        actions = self.apply_action(expired)
+        self.report(expiring, expired, new_expiring | new_expired, actions)
+
+    def apply_action(self, expired):
+        """Apply the configured action to expired machines that are still running; return dictionary of actions applied"""
+        action = self.cfg.sweeper_action(self.node)
+        actions = dict()
+        if action == 'report':
+            return actions
+        if action not in ['shutdown', 'stop', 'suspend']:
+            self.log(logging.WARNING, f'invalid action [{action}] configured')
+            return actions
+        delay = self.cfg.sweeper_action_delay(self.node)
+        attempted = False
+        for id, vm in sorted(expired.items()):
+            if (id in self.acted) or (vm.get('status') != 'running'):
+                continue
+            # Spread the actions over time so that a sweep never causes a load spike on the Proxmox API (failed attempts count as well)
+            if attempted and self._stop_event.wait(delay):
+                break
+            attempted = True
+            if self.cfg.dryrun(self.node):
+                self.log(logging.INFO, f'would trigger [{action}] on expired machine [{id}] (dryrun)')
+                actions[id] = f'{action} (dryrun)'
+            else:
+                try:
+                    self.api.trigger_vm_action(id, action)
+                except Exception as e:
+                    self.log(logging.WARNING, f'triggering [{action}] on machine [{id}] failed: {str(e)}')
+                    continue
+                self.log(logging.INFO, f'triggered [{action}] on expired machine [{id}]')
+                actions[id] = action
+            if self.audit_log is not None:
+                self.audit_log.log('vm_action', user=self.cfg.sweeper_user(self.node), node=self.node, id=id, action=action,
+                                   dryrun=self.cfg.dryrun(self.node), reason='expired')
+            self.acted.add(id)
+        return actions
+
+    def report_rows(self, expiring, expired, new, actions):
+        """Generate the rows of the expiry report"""
+        for state, vms in [('expiring', expiring), ('expired', expired)]:
+            for id, vm in sorted(vms.items()):
+                yield {
+                    'id': id,
+                    'vmid': vm.get('vmid'),
+                    'node': vm.get('node'),
+                    'name': vm.get('name', ''),
+                    'status': vm.get('status', ''),
+                    'expiry': vm['tag_expiry'].isoformat(),
+                    'state': state,
+                    'new': id in new,
+                    'action': actions.get(id, ''),
+                }
+
+    def report(self, expiring, expired, new, actions):
+        """Write the expiry report to the configured file (JSON or CSV)"""
+        filename = self.cfg.sweeper_report_file(self.node)
+        if not filename:
+            for row in self.report_rows(expiring, expired, new, actions):
+                if row['new'] or row['action']:
+                    self.log(logging.INFO, json.dumps(row))
+            return
+        filename = filename.format(node=self.node)
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w', newline='') as f:
+                if filename.endswith('.csv'):
+                    writer = csv.DictWriter(f, fieldnames=report_fields)
+                    writer.writeheader()
+                    writer.writerows(self.report_rows(expiring, expired, new, actions))
+                else:
+                    data = {
+                        'node': self.node,
+                        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'machines': list(self.report_rows(expiring, expired, new, actions)),
+                    }
+                    json.dump(data, f, indent=2)
+            os.replace(tmp_filename, filename) # atomically replace so that readers never see a partial report
+        except OSError as e:
+            self.log(logging.WARNING, f'could not write report file [{filename}]: {str(e)}')
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Subclasses of the "proxmoxer" https backend supporting authentication with an existing ticket instead of a password
+# Note: This module imports "requests"; it is thus only imported on demand, see proxapi.install_ticket_support()
+
+import proxmoxer
+from proxmoxer import SERVICES
+from proxmoxer.backends import https
+from proxmoxer.core import config_failure
+
+
+class TicketHTTPAuth(https.ProxmoxHTTPAuth):
+    """ProxmoxHTTPAuth that reuses a given ticket (renewing it) instead of requiring a password"""
+
+    def __init__(self, username, password, otp=None, base_url="", otptype="totp", ticket=None, **kwargs):
+        """See original at https://github.com/proxmoxer/proxmoxer/blob/develop/proxmoxer/backends/https.py"""
+        # Replace super().__init__(...) since the original always authenticates with the password
+        https.ProxmoxHTTPAuthBase.__init__(self, **kwargs)
+
+        self.base_url = base_url
+        self.username = username
+        # Use ticket if available
+        self.pve_auth_ticket = ticket if (ticket is not None) else ""
+
+        self._get_new_tokens(password=password, otp=otp)
+
+
+class TicketBackend(https.Backend):
+    """https Backend passing on the "ticket" keyword parameter to TicketHTTPAuth"""
+
+    def __init__(
+        self,
+        host,
+        user=None,
+        password=None,
+        ticket=None,
+        otp=None,
+        port=None,
+        verify_ssl=True,
+        mode="json",
+        timeout=5,
+        token_name=None,
+        token_value=None,
+        path_prefix=None,
+        service="PVE",
+        cert=None,
+        proxies=None,
+    ):
+        """See original file at https://github.com/proxmoxer/proxmoxer/blob/develop/proxmoxer/backends/https.py"""
+        # Notes:
+        # The only changes are:
+        # - adding and passing on "ticket" keyword parameter
+        # - allowing password==None if ticket is provided
+
+        self.proxies = proxies
+        self.cert = cert
+        host_port = ""
+        if len(host.split(":")) > 2:  # IPv6
+            if host.startswith("["):
+                if "]:" in host:
+                    host, host_port = host.rsplit(":", 1)
+            else:
+                host = f"[{host}]"
+        elif ":" in host:
+            host, host_port = host.split(":")
+        port = host_port if host_port.isdigit() else port
+
+        # if a port is not specified, use the default port for this service
+        if not port:
+            port = SERVICES[service]["default_port"]
+
+        self.mode = mode
+        if path_prefix is not None:
+            self.base_url = f"https://{host}:{port}/{path_prefix}/api2/{mode}"
+        else:
+            self.base_url = f"https://{host}:{port}/api2/{mode}"
+
+        if token_name is not None:
+            if "token" not in SERVICES[service]["supported_https_auths"]:
+                config_failure("{} does not support API Token authentication", service)
+
+            self.auth = https.ProxmoxHTTPApiTokenAuth(
+                user,
+                token_name,
+                token_value,
+                verify_ssl=verify_ssl,
+                timeout=timeout,
+                service=service,
+                cert=self.cert,
+                proxies=proxies,
+            )
+        # The following line got changed
+        elif (password is not None) or (ticket is not None):
+            if "password" not in SERVICES[service]["supported_https_auths"]:
+                config_failure("{} does not support password authentication", service)
+
+            self.auth = TicketHTTPAuth(
+                user,
+                password,
+                otp,
+                base_url=self.base_url,
+                # The following line got changed
+                ticket=ticket,
+                verify_ssl=verify_ssl,
+                timeout=timeout,
+                service=service,
+                cert=self.cert,
+                proxies=proxies,
+            )
+        else:
+            config_failure("No valid authentication credentials were supplied")
+
+
+class TicketProxmoxAPI(proxmoxer.ProxmoxAPI):
+    """ProxmoxAPI always using the ticket-enabled https backend"""
+
+    def __init__(self, host, service='PVE', **kwargs):
+        """Object initialization; replaces ProxmoxAPI.__init__ since the latter always instantiates the original backend"""
+        proxmoxer.core.ProxmoxResource.__init__(self)
+        service = service.upper()
+        self._backend = TicketBackend(host, service=service, **kwargs)
+        self._backend_name = 'https'
+        self._store = {
+            'base_url': self._backend.get_base_url(),
+            'session': self._backend.get_session(),
+            'serializer': self._backend.get_serializer(),
+        }
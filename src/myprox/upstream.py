@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Protection of the Proxmox API against bursts caused by MyProx: identical concurrent read calls share one upstream
+# request (single-flight) and the number of concurrent upstream calls per node is limited
+# A circuit breaker per node lets calls fail fast while the node's API is unreachable
+
+import contextlib
+import threading
+import time
+import urllib.parse
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling a node whose circuit breaker is open"""
+    pass
+
+
+class Call():
+    """A call in flight whose result is shared by all callers waiting for it"""
+
+    def __init__(self):
+        """Object initialization"""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """Lets concurrent callers using the same key share the result of a single call"""
+
+    def __init__(self):
+        """Object initialization"""
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """Return func(); if a call with the same key is in flight already, wait for it and return its result instead"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = func()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class ConcurrencyLimit():
+    """Limits the number of concurrent upstream calls to a node and records how long callers have to wait (queue time)
+    Also acts as circuit breaker: after a number of consecutive failures (connection errors, timeouts, gateway errors), calls
+    are refused for some seconds; afterwards, calls are let through again but the next failure reopens the breaker"""
+
+    def __init__(self, limit, failure_threshold=5, open_seconds=30):
+        """Object initialization"""
+        self.limit = limit
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0 # consecutive failures
+        self.open_until = 0.0
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+        self.calls = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager waiting for and holding one of the node's call slots"""
+        start = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+        self.semaphore.acquire()
+        queue_time = time.monotonic() - start
+        with self.lock:
+            self.waiting -= 1
+            self.active += 1
+            self.calls += 1
+            self.queue_time_total += queue_time
+            self.queue_time_max = max(self.queue_time_max, queue_time)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.semaphore.release()
+
+    def is_open(self):
+        """Whether the circuit breaker is open, i.e. calls are currently refused"""
+        return time.monotonic() < self.open_until
+
+    def record(self, success):
+        """Record the outcome of a call for the circuit breaker"""
+        with self.lock:
+            if success:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.open_until = time.monotonic() + self.open_seconds
+
+    def metrics(self):
+        """Return the current metrics as dictionary (queue times in seconds; the maximum is reset on each call)"""
+        with self.lock:
+            result = {
+                'breaker_open': self.is_open(),
+                'failures': self.failures,
+                'limit': self.limit,
+                'active': self.active,
+                'waiting': self.waiting,
+                'calls': self.calls,
+                'queue_time_avg': round(self.queue_time_total / self.calls, 4) if self.calls else 0.0,
+                'queue_time_max': round(self.queue_time_max, 4),
+            }
+            self.queue_time_max = 0.0
+        return result
+
+
+# HTTP status codes indicating that the node's API is not reachable
+gateway_errors = [502, 503, 504]
+# HTTP status codes used by Proxmox if the contacted node can't reach another cluster node it proxies the request to
+# ("no route to host" etc.); they only indicate a problem of the contacted node if the request was not meant for another one
+proxy_errors = [595, 596]
+
+single_flight = SingleFlight()
+
+_limits = dict()
+_limits_lock = threading.Lock()
+
+
+def get_limit(node, limit):
+    """Return the concurrency limit of the given node (created with the given number of slots on first use)"""
+    with _limits_lock:
+        if node not in _limits:
+            _limits[node] = ConcurrencyLimit(limit)
+        return _limits[node]
+
+def is_failure(status_code, url):
+    """Whether a response indicates that the contacted node's API is not reachable (counted by the circuit breaker)"""
+    if status_code in gateway_errors:
+        return True
+    return (status_code in proxy_errors) and ('/nodes/' not in urllib.parse.urlsplit(url).path)
+
+def metrics():
+    """Return the metrics of all nodes and the number of coalesced calls"""
+    with _limits_lock:
+        limits = dict(_limits)
+    return {
+        'coalesced': single_flight.coalesced,
+        'nodes': { node: limit.metrics() for node, limit in limits.items() },
+    }
+
+
+class GuardedSession():
+    """Wraps the HTTP session of a proxmoxer instance: read calls are coalesced per auth scope, all calls are limited per node"""
+
+    def __init__(self, session, node, scope, limit=8):
+        """Object initialization (node: identifies the Proxmox API, e.g. its host; scope: identifies the credentials, e.g. the user)"""
+        self.session = session
+        self.node = node
+        self.scope = scope
+        self.limit = get_limit(node, limit)
+
+    def __getattr__(self, name):
+        """Delegate everything else to the wrapped session"""
+        return getattr(self.session, name)
+
+    def request(self, method, url, data=None, params=None, **kwargs):
+        """Do the request; identical GET requests of the same scope that are in flight at the same time share one response"""
+        def call():
+            if self.limit.is_open():
+                raise UpstreamUnavailable(f'Proxmox API [{self.node}] is currently not reachable')
+            with self.limit.slot():
+                try:
+                    response = self.session.request(method, url, data=data, params=params, **kwargs)
+                except Exception:
+                    self.limit.record(False)
+                    raise
+            self.limit.record(not is_failure(response.status_code, url))
+            return response
+        if (method != 'GET') or data or kwargs:
+            return call()
+        key = (self.node, self.scope, url, tuple(sorted((params or dict()).items())))
+        return single_flight.do(key, call)
@@ -3,18 +3,52 @@
 
 
 import cherrypy
-import jinja2
+import csv
+import io
 import json
 import logging
 import os
 import random
-import requests
 import string
+import threading
+import time
 import urllib.parse
 
-import proxmoxer
+from . import admission
+from . import audit
+from . import federation
+from . import inventory
 from . import myproxapi
+from . import proxapi
 from . import setupenv
+from . import sparkline
+from . import sweeper
+from . import upstream
+
+
+# Proxmox privileges needed for the actions offered to the user
+action_privileges = {
+    'start': ['VM.PowerMgmt'],
+    'reboot': ['VM.PowerMgmt'],
+    'shutdown': ['VM.PowerMgmt'],
+    'reset': ['VM.PowerMgmt'],
+    'stop': ['VM.PowerMgmt'],
+    'suspend': ['VM.PowerMgmt'],
+    'resume': ['VM.PowerMgmt'],
+    'console': ['VM.Console'],
+    'console_vnc': ['VM.Console'],
+    'start_console': ['VM.PowerMgmt', 'VM.Console'],
+    'start_console_vnc': ['VM.PowerMgmt', 'VM.Console'],
+    'extend': ['VM.Config.Options'],
+}
+
+
+# Timeframes offered for the resource usage history
+usage_timeframes = ['hour', 'day', 'week']
+
+# Formats of the machine list export with their content types, and the exported fields
+export_formats = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+export_fields = ['id', 'vmid', 'name', 'type', 'node', 'status', 'template', 'cpus', 'maxmem', 'maxdisk', 'uptime', 'expiry', 'tags']
 
 
 class WebApp():
@@ -22,22 +56,137 @@ class WebApp():
     def __init__(self, cfg):
         """Instance initialization"""
         self.cfg = cfg
-        self.jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
+        self._jinja_env = None
+        self.audit_log = audit.AuditLog(cfg.audit_log_file, max_bytes=cfg.audit_log_max_bytes, rotate_seconds=cfg.audit_log_rotate_seconds,
+                                        backup_count=cfg.audit_log_backup_count, queue_size=cfg.audit_log_queue_size)
+        self.admission = admission.AdmissionControl(cfg.server_thread_pool - cfg.admission_reserved_threads, cfg.admission_queue_threshold,
+                                                    retry_after=cfg.admission_retry_after)
+        self.inventory = inventory.InventorySnapshot(cfg.inventory_snapshot_file, max_age=cfg.inventory_snapshot_max_age,
+                                                     resync_interval=cfg.inventory_resync_interval)
+        self._task_log_apis = dict() # node -> API instance with service credentials for reading the task log
+
+    @property
+    def jinja_env(self):
+        """The Jinja2 environment (jinja2 is imported on first use to speed up startup)"""
+        if self._jinja_env is None:
+            import jinja2
+            self._jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
+        return self._jinja_env
+
+    def warm_up(self):
+        """Import heavy modules and compile the templates in the background so that neither startup nor the first requests are delayed"""
+        def run():
+            proxapi.install_ticket_support()
+            for name in ['login.html', 'index.html', 'manage.html']:
+                self.jinja_env.get_template(name)
+            self.check_roles()
+        threading.Thread(target=run, name='Warm-up', daemon=True).start()
+
+    def check_roles(self):
+        """Check the MyProx user role on each node that has service credentials configured"""
+        for node in (self.cfg.nodes or [None]):
+            if self.cfg.sweeper_user(node):
+                try:
+                    myproxapi.connect_service(self.cfg, node).check_role_VMUserMyProx()
+                except Exception as e:
+                    cherrypy.log(f'Role check for node [{node}] failed: {str(e)}', context='SETUP', severity=logging.WARNING, traceback=False)
+
+    def is_permitted(self, action, id, pool=None):
+        """Check whether the user is permitted to do the given action on the given VM (based on the session's permission cache)
+        pool: the VM's pool if known (pool-level permissions count as well)"""
+        proxmox = cherrypy.session['proxmox']
+        try:
+            vmid, node = proxmox.decompose_id(id)
+            proxmox = proxmox.api_for(id)
+        except ValueError:
+            return True # invalid identifiers are reported elsewhere
+        return all([ proxmox.has_permission(privilege, vmid, pool) for privilege in action_privileges.get(action, []) ])
+
+    def get_node(self, id=None):
+        """Return the node (config section) responsible for the given VM; in federated mode this depends on the VM"""
+        proxmox = cherrypy.session.get('proxmox')
+        if (id is not None) and isinstance(proxmox, federation.FederatedMyProxAPI):
+            try:
+                return proxmox.endpoint_for(id)
+            except ValueError:
+                pass # invalid identifiers are reported elsewhere
+        return cherrypy.session.get('node')
+
+    def lock_session(self):
+        """Lock the session of the current request until it is saved (with explicit session locking, requests only reading
+        the session are not locked and run concurrently; requests changing the session or a machine need to lock it)"""
+        if not cherrypy.session.locked:
+            cherrypy.session.acquire_lock()
+            cherrypy.session.load() # changes saved by other requests while waiting for the lock
+
+    def unlock_session(self):
+        """Release the session lock early, e.g. before waiting, once the request doesn't change the session anymore"""
+        if cherrypy.session.locked:
+            cherrypy.session.release_lock()
+
+    def lock_anonymous_session(self):
+        """Lock the session if nobody is logged in yet (the login writes the session, which must not be overwritten by
+        concurrent requests having loaded the still empty session)"""
+        if cherrypy.session.get('username') is None:
+            self.lock_session()
+
+    def inventory_scope(self):
+        """Return endpoint and user identifying the machine list of the current session in the inventory snapshot"""
+        proxmox = cherrypy.session['proxmox']
+        if isinstance(proxmox, federation.FederatedMyProxAPI):
+            endpoint = ','.join(sorted(proxmox.apis.keys()))
+        else:
+            endpoint = cherrypy.session.get('node') or ''
+        return endpoint, cherrypy.session.get('username')
+
+    def follows_tasks(self, proxmox):
+        """Whether the machine list can be updated incrementally based on the task log (not in federated mode spanning several clusters)"""
+        return not isinstance(proxmox, federation.FederatedMyProxAPI)
+
+    def task_log_api(self, proxmox):
+        """Return an API instance with the service credentials of the session's node for reading the complete task log when updating the
+        machine list incrementally (None if not needed or not configured; then the user's own credentials are used, seeing own tasks only)"""
+        node = cherrypy.session.get('node')
+        if (not self.follows_tasks(proxmox)) or (self.inventory.resync_interval <= 0) or (not self.cfg.sweeper_user(node)):
+            return None
+        if node not in self._task_log_apis:
+            try:
+                self._task_log_apis[node] = myproxapi.connect_service(self.cfg, node)
+            except Exception as e:
+                cherrypy.log(f'Could not connect service user for reading the task log of node [{node}]: {str(e)}', context='WEBAPP', severity=logging.WARNING, traceback=False)
+                return None
+        return self._task_log_apis[node]
+
+    def format_time(self, timestamp):
+        """Format the given time (seconds since the epoch) for display; None stays None"""
+        if timestamp is None:
+            return None
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+    def audit(self, event, user=None, **fields):
+        """Record an event of the current request in the audit log"""
+        if user is None:
+            user = cherrypy.session.get('username')
+        self.audit_log.log(event, user=user, ip=cherrypy.request.remote.ip, node=cherrypy.session.get('node'), **fields)
 
     @cherrypy.expose
     def index(self, action=None, id=None, action_selection=None):
         """Show a list of existing machines"""
-        node = cherrypy.session.get('node')
-        vms = cherrypy.session['proxmox'].get_virtual_machines()
+        proxmox = cherrypy.session['proxmox']
+        endpoint, user = self.inventory_scope()
+        vms, stale = self.inventory.get_machines(endpoint, user, proxmox, self.follows_tasks(proxmox), self.task_log_api(proxmox))
         #cherrypy.log(str(vms), context='WEBAPP', severity=logging.INFO, traceback=False)
+        unavailable = [ self.cfg.nodes.get(node, node) for node in sorted(getattr(proxmox, 'failed', dict())) ]
         tmpl = self.jinja_env.get_template('index.html')
-        return tmpl.render(sessiondata=cherrypy.session, machines=vms)
+        return tmpl.render(sessiondata=cherrypy.session, machines=vms, permitted=self.is_permitted, unavailable=unavailable,
+                           stale=self.format_time(stale))
 
     @cherrypy.expose
-    def manage(self, action=None, id=None, action_selection=None):
+    def manage(self, action=None, id=None, action_selection=None, timeframe='hour'):
         """Manage a machine"""
-        node = cherrypy.session.get('node')
+        node = self.get_node(id)
         machine_data = None
+        stale = None
         message = None
         try:
             if id:
@@ -50,16 +199,26 @@ class WebApp():
                 'suspend': 'suspension (hibernation) triggered',
                 'resume': 'resume triggered'
                 }
-                if action_selection in action_results.keys():
+                if not self.is_permitted(action_selection, id):
+                    message = 'Error: you are not permitted to do this on this machine'
+                elif action_selection in action_results.keys():
+                    self.lock_session()
                     if not self.cfg.dryrun(node):
                         cherrypy.session['proxmox'].trigger_vm_action(id, action_selection)
+                    self.audit('vm_action', id=id, action=action_selection, dryrun=self.cfg.dryrun(node))
                     message = f'Machine {action_results[action_selection]}.'
                 elif action_selection == 'console':
-                    raise cherrypy.HTTPRedirect(f'/console?id={id}')
+                    raise cherrypy.HTTPRedirect('/console?' + urllib.parse.urlencode([('id', id)]))
                 elif action_selection == 'console_vnc':
-                    raise cherrypy.HTTPRedirect(f'/console_vnc?id={id}')
+                    raise cherrypy.HTTPRedirect('/console_vnc?' + urllib.parse.urlencode([('id', id)]))
+                elif action_selection == 'start_console':
+                    raise cherrypy.HTTPRedirect('/start_console?' + urllib.parse.urlencode([('id', id)]))
+                elif action_selection == 'start_console_vnc':
+                    raise cherrypy.HTTPRedirect('/start_console?type=vnc&' + urllib.parse.urlencode([('id', id)]))
                 elif action_selection == 'extend':
+                    self.lock_session()
                     cherrypy.session['proxmox'].set_tag_expiry_bydays(id, self.cfg.expiry_prolongation_days(node))
+                    self.audit('expiry_extend', id=id, days=self.cfg.expiry_prolongation_days(node))
                     message = 'The expiry data of this machine has been set according to the prolongation policy of your organization.'
                 elif action_selection == 'destroy':
                     message = 'The functionality to destroy a machine is not yet implemented. . Contact support to do this.'
@@ -71,6 +230,14 @@ class WebApp():
                     message = 'Error: invalid action specified'
             else:
                 message = 'Error: no identifier given'        
+            if not machine_data and id and (action_selection is None):
+                # Serve data from the inventory snapshot right after a restart while refreshing in the background
+                endpoint, user = self.inventory_scope()
+                machine_data, stale = self.inventory.get_stale_machine(endpoint, user, id)
+                if machine_data is not None:
+                    machine_data['tag_expiry'] = myproxapi.parse_expiry(myproxapi.parse_tags(machine_data.get('tags')))
+                    proxmox = cherrypy.session['proxmox']
+                    self.inventory.refresh_in_background(endpoint, user, proxmox, self.follows_tasks(proxmox), self.task_log_api(proxmox))
             if not machine_data and id:
                 machine_data = cherrypy.session['proxmox'].get_virtual_machine_with_tags(id)
         except ValueError as e:
@@ -79,7 +246,32 @@ class WebApp():
             machine_data = dict()
         #cherrypy.log(str(machine_data), context='WEBAPP', severity=logging.WARNING, traceback=False)
         tmpl = self.jinja_env.get_template('manage.html')
-        return tmpl.render(sessiondata=cherrypy.session, itemdata=machine_data, message=message)
+        allowed = { action: self.is_permitted(action, id, machine_data.get('pool')) for action in action_privileges.keys() }
+        if timeframe not in usage_timeframes:
+            timeframe = 'hour'
+        usage = self.get_usage_sparklines(id, timeframe) if (machine_data and stale is None) else []
+        return tmpl.render(sessiondata=cherrypy.session, itemdata=machine_data, message=message, allowed=allowed,
+                           usage=usage, timeframe=timeframe, timeframes=usage_timeframes, stale=self.format_time(stale))
+
+    def get_usage_sparklines(self, id, timeframe):
+        """Return the resource usage history of the given machine as list of (caption, latest value, SVG sparkline)"""
+        proxmox = cherrypy.session['proxmox']
+        try:
+            usage = proxmox.get_usage_history(id, timeframe)
+        except Exception as e:
+            cherrypy.log(f'Could not get usage history of [{id}]: {str(e)}', context='WEBAPP', severity=logging.DEBUG, traceback=False)
+            return []
+        result = []
+        for key, caption, maximum in [('cpu', 'CPU', 100), ('mem', 'Memory', 100), ('net', 'Network', None), ('disk', 'Disk I/O', None)]:
+            values = [ value for value in usage[key] if value is not None ]
+            if not values:
+                continue
+            if maximum is None:
+                latest = proxmox.int2human(values[-1]) + 'B/s'
+            else:
+                latest = f'{values[-1]:.0f}%'
+            result.append((caption, latest, sparkline.render_svg(usage[key], maximum)))
+        return result
 
     @cherrypy.expose
     def create(self, action=None, id=None):
@@ -88,28 +280,60 @@ class WebApp():
         raise cherrypy.HTTPRedirect(self.cfg.machine_creation_url(node).format(username=cherrypy.session['username']))
 
     @cherrypy.expose
-    def console(self, id=None):
-        """Provide a connection file for download"""
-        cherrypy.log(f'Attempting to download connection file for [{id}] by user [{cherrypy.session["username"]}]', context='WEBAPP', severity=logging.INFO, traceback=False)
+    def export(self, format='csv'):
+        """Export the list of machines incl. expiry date as CSV or JSON Lines (for scripts; rows are streamed as they are retrieved)"""
+        if format not in export_formats:
+            raise cherrypy.HTTPError(400, f'Unsupported format; use one of: {", ".join(export_formats.keys())}')
+        proxmox = cherrypy.session['proxmox']
+        self.audit('export', format=format)
+        cherrypy.response.headers['Content-Type'] = export_formats[format]
+        cherrypy.response.headers['Content-Disposition'] = f'attachment; filename=machines.{format}'
+        return self.export_rows(proxmox, format)
+    export._cp_config = {'response.stream': True}
+
+    def export_rows(self, proxmox, format):
+        """Generate the encoded export row by row"""
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=export_fields, extrasaction='ignore', lineterminator='\n')
+        if format == 'csv':
+            writer.writeheader()
+            yield buffer.getvalue().encode('utf-8')
         try:
-            file_dict = cherrypy.session['proxmox'].get_spice(id)
-            file_data = '[virt-viewer]\n'
-            for key, value in file_dict.items():
-                file_data += f'{key}={value}\n'
-            cherrypy.log(str(file_data), context='WEBAPP', severity=logging.DEBUG, traceback=False)
-            filename = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(6)])
-            #cherrypy.response.headers['Content-Disposition'] = f'attachment; filename={filename}.vv'
-            cherrypy.response.headers['Content-Disposition'] = f'inline; filename={filename}.vv'
-            cherrypy.response.headers['Content-Type'] = 'application/x-virt-viewer'
-            return file_data.encode('utf-8')
+            for vm in proxmox.iter_virtual_machines():
+                expiry = myproxapi.parse_expiry(myproxapi.parse_tags(vm.get('tags')))
+                row = { field: vm.get(field, '') for field in export_fields }
+                row['template'] = int(vm.get('template') or 0)
+                row['expiry'] = expiry.isoformat() if expiry is not None else ''
+                if format == 'csv':
+                    buffer.seek(0)
+                    buffer.truncate()
+                    writer.writerow(row)
+                    yield buffer.getvalue().encode('utf-8')
+                else:
+                    yield (json.dumps(row) + '\n').encode('utf-8')
         except Exception as e:
-            return str(e)
+            # The response has been started already: abort it (the connection is closed without ending the chunked body)
+            # so that clients don't take the incomplete export for a complete one
+            cherrypy.log(f'Export aborted: {str(e)}', context='WEBAPP', severity=logging.WARNING, traceback=False)
+            raise
 
-    @cherrypy.expose
-    def console_vnc(self, id=None):
-        """Open a VNC console for the provided VM using Proxmox' web console"""
-        node = cherrypy.session.get('node')
-        token = cherrypy.session['proxmox'].proxmox.get_tokens()[0]
+    def spice_file(self, id):
+        """Return a SPICE connection file for the provided VM as response body"""
+        file_dict = cherrypy.session['proxmox'].get_spice(id)
+        file_data = '[virt-viewer]\n'
+        for key, value in file_dict.items():
+            file_data += f'{key}={value}\n'
+        cherrypy.log(str(file_data), context='WEBAPP', severity=logging.DEBUG, traceback=False)
+        filename = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(6)])
+        #cherrypy.response.headers['Content-Disposition'] = f'attachment; filename={filename}.vv'
+        cherrypy.response.headers['Content-Disposition'] = f'inline; filename={filename}.vv'
+        cherrypy.response.headers['Content-Type'] = 'application/x-virt-viewer'
+        return file_data.encode('utf-8')
+
+    def vnc_redirect(self, id):
+        """Set the Proxmox authentication cookie and redirect to Proxmox' VNC web console for the provided VM"""
+        node = self.get_node(id)
+        token = cherrypy.session['proxmox'].api_for(id).proxmox.get_tokens()[0]
         cherrypy.response.cookie['PVEAuthCookie'] = token        
         cherrypy.response.cookie['PVEAuthCookie']._coded_value = token # automatic encoding adds quotes; since these break Proxmox authentication, override automatic quoting
         cherrypy.response.cookie['PVEAuthCookie']['path'] = '/'
@@ -124,8 +348,65 @@ class WebApp():
         cherrypy.log(f'Auth cookie set: {cherrypy.response.cookie["PVEAuthCookie"].output()}', context='WEBAPP', severity=logging.DEBUG)
         # Proxmox does e.g. https://192.168.202.16:8006/?console=kvm&novnc=1&vmid=112&vmname=dh-testvm&node=dh-nas6&resize=off&cmd='
         prox = self.cfg.proxmox_api_withport(node)
-        vmid, node = cherrypy.session['proxmox'].decompose_id(id)
-        raise cherrypy.HTTPRedirect(f'https://{prox}/?console=kvm&novnc=1&vmid={vmid}&node={node}&resize=off&cmd=')
+        vmtype, vmid, node = cherrypy.session['proxmox'].decompose_guest_id(id)
+        console = 'kvm' if vmtype == 'qemu' else 'lxc'
+        raise cherrypy.HTTPRedirect(f'https://{prox}/?console={console}&novnc=1&vmid={vmid}&node={node}&resize=off&cmd=')
+
+    @cherrypy.expose
+    def console(self, id=None):
+        """Provide a connection file for download"""
+        cherrypy.log(f'Attempting to download connection file for [{id}] by user [{cherrypy.session["username"]}]', context='WEBAPP', severity=logging.INFO, traceback=False)
+        if not self.is_permitted('console', id):
+            return 'You are not permitted to open the console of this machine'
+        try:
+            result = self.spice_file(id)
+            self.audit('console', id=id, type='spice')
+            return result
+        except Exception as e:
+            self.audit('console', id=id, type='spice', error=str(e))
+            return str(e)
+
+    @cherrypy.expose
+    def console_vnc(self, id=None):
+        """Open a VNC console for the provided VM using Proxmox' web console"""
+        if not self.is_permitted('console_vnc', id):
+            return 'You are not permitted to open the console of this machine'
+        self.audit('console', id=id, type='vnc')
+        self.vnc_redirect(id)
+
+    @cherrypy.expose
+    def start_console(self, id=None, type='spice'):
+        """Start the provided VM if needed, wait until it is running and then open its console (SPICE file or VNC redirect)"""
+        node = self.get_node(id)
+        proxmox = cherrypy.session['proxmox']
+        cherrypy.log(f'Attempting to start and connect to [{id}] by user [{cherrypy.session["username"]}]', context='WEBAPP', severity=logging.INFO, traceback=False)
+        if not self.is_permitted('start_console', id):
+            return 'You are not permitted to start this machine or to open its console'
+        self.lock_session()
+        try:
+            state = proxmox.power_state(proxmox.get_vm_status(id))
+            if state != 'running':
+                if state in ['paused', 'suspended']:
+                    action = 'resume'
+                elif state == 'stopped':
+                    action = 'start' # also resumes machines hibernated to disk
+                else:
+                    return f'The machine cannot be started in its current state [{state}]'
+                upid = None
+                if not self.cfg.dryrun(node):
+                    upid = proxmox.trigger_vm_action(id, action)
+                self.audit('vm_action', id=id, action=action, dryrun=self.cfg.dryrun(node))
+                if not self.cfg.dryrun(node): # nothing to wait for if no action has been sent
+                    self.unlock_session() # don't block the user's other requests while waiting
+                    proxmox.wait_until_running(id, upid, timeout=self.cfg.start_console_timeout(node))
+            self.audit('console', id=id, type=type)
+            if type == 'vnc':
+                return self.vnc_redirect(id)
+            return self.spice_file(id)
+        except cherrypy.HTTPRedirect:
+            raise
+        except Exception as e:
+            return str(e)
 
     @cherrypy.expose
     def start(self, id=None):
@@ -134,10 +415,13 @@ class WebApp():
 
     def get_myprox_instance(self, node, username, password=None, ticket=None):
         """Connect to ProxmoxAPI with provided credentials and store reference in session"""
+        import proxmoxer # imported on demand to speed up startup
         try:
             try:
-                cherrypy.session['proxmox'] = myproxapi.MyProxAPI(self.cfg.proxmox_api(node), username, password, ticket, self.cfg.proxmox_api_verifyssl(node))
-            except proxmoxer.backends.https.AuthenticationError as e:
+                cherrypy.session['proxmox'] = myproxapi.MyProxAPI(self.cfg.proxmox_api(node), username, password, ticket, self.cfg.proxmox_api_verifyssl(node),
+                                                                  permissions_ttl=self.cfg.permissions_cache_ttl(node), usage_ttl=self.cfg.usage_cache_ttl(node),
+                                                                  upstream_limit=self.cfg.upstream_concurrency(node))
+            except proxmoxer.core.AuthenticationError as e:
                 cherrypy.log(f'Wrong credentials for user ["{username}"]', context='WEBAPP', severity=logging.INFO, traceback=False)
                 return 'invalid username/password'
         except Exception as e:
@@ -146,6 +430,26 @@ class WebApp():
             return 'Error accessing Proxmox - please try again later'
         return None
 
+    def get_federated_instance(self, username, password):
+        """Connect to the ProxmoxAPI of all federated nodes concurrently and store a combined reference in session"""
+        import proxmoxer # imported on demand to speed up startup
+        def connect(node):
+            node_username = username if '@' in username else username + '@' + self.cfg.proxmox_default_auth_domain(node)
+            return myproxapi.MyProxAPI(self.cfg.proxmox_api(node), node_username, password, None, self.cfg.proxmox_api_verifyssl(node),
+                                       permissions_ttl=self.cfg.permissions_cache_ttl(node), usage_ttl=self.cfg.usage_cache_ttl(node),
+                                       upstream_limit=self.cfg.upstream_concurrency(node))
+        apis, errors = federation.run_concurrently(connect, self.cfg.federation_nodes, self.cfg.federation_timeout)
+        for node, e in errors.items():
+            cherrypy.log(f'Login of user ["{username}"] at node [{node}] failed: {str(e)}', context='WEBAPP', severity=logging.INFO, traceback=False)
+        if not apis:
+            if errors and all([ isinstance(e, proxmoxer.core.AuthenticationError) for e in errors.values() ]):
+                return 'invalid username/password'
+            return 'Error accessing Proxmox - please try again later'
+        # Nodes rejecting the credentials are left out silently (the user might not have an account there); others are reported
+        unavailable = { node: str(e) for node, e in errors.items() if not isinstance(e, proxmoxer.core.AuthenticationError) }
+        cherrypy.session['proxmox'] = federation.FederatedMyProxAPI(apis, self.cfg.federation_timeout, unavailable)
+        return None
+
     def add_node_in_state_parameter(self, url, node):
         """Update the state query parameter of an URL to include node information in its JSON value"""
         # Parse the URL
@@ -189,17 +493,21 @@ class WebApp():
             'redirect-url': self.cfg.oidc_redirect_url
         }
         cherrypy.log(f'HTTP POST request to API at [{api_endpoint}] with data [{data}]', context='WEBAPP', severity=logging.DEBUG, traceback=False)
+        import requests # imported on demand to speed up startup
         response = requests.post(api_endpoint, data=data)
         if response.status_code == 200:
             result = response.json()
             username = result.get('data', {}).get('username')
             ticket = result.get('data', {}).get('ticket')
             if ticket and username:
+                self.lock_session()
                 cherrypy.session['username'] = username
                 # Connect to ProxmoxAPI with provided credentials and store reference in session
                 error_text = self.get_myprox_instance(node, username, ticket=ticket)
                 if error_text is not None:
+                    self.audit('login', user=username, method='oidc', success=False, error=error_text)
                     raise cherrypy.HTTPError(500, error_text)
+                self.audit('login', user=username, method='oidc', success=True)
                 raise cherrypy.HTTPRedirect('/')
             else:
                 raise cherrypy.HTTPError(500, 'Authentication failed: Missing ticket or username')
@@ -217,6 +525,7 @@ class WebApp():
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         cherrypy.log(f'HTTP POST request to API at [{api_endpoint}] with redirect url [{self.cfg.oidc_redirect_url}]', context='WEBAPP', severity=logging.DEBUG, traceback=False)
+        import requests # imported on demand to speed up startup
         response = requests.post(api_endpoint, data=data, headers=headers)
         if response.status_code == 200:
             result = response.json()
@@ -231,6 +540,7 @@ class WebApp():
 
     def check_username_and_password(self, username, password):
         """Check whether provided username and password are valid when authenticating"""
+        self.lock_session()
         node = cherrypy.request.params.get('node')
         if node is not None:
             cherrypy.session['node'] = node
@@ -242,19 +552,25 @@ class WebApp():
         # OIDC login
         if (username == '') and self.cfg.proxmox_oidc_auth_domain(node):
             self.trigger_oidc_auth(node)
-        # Add default domain in case no domain provided
-        if '@' not in username:
-            username += '@' + self.cfg.proxmox_default_auth_domain(node)
-        # Connect to ProxmoxAPI with provided credentials and store reference in session
-        error_text = self.get_myprox_instance(node, username, password)
+        if self.cfg.federation:
+            # Connect to all federated nodes (each with its default domain in case no domain provided)
+            error_text = self.get_federated_instance(username, password)
+        else:
+            # Add default domain in case no domain provided
+            if '@' not in username:
+                username += '@' + self.cfg.proxmox_default_auth_domain(node)
+            # Connect to ProxmoxAPI with provided credentials and store reference in session
+            error_text = self.get_myprox_instance(node, username, password)
         if error_text is not None:
+            self.audit('login', user=username, method='password', success=False, error=error_text)
             return error_text
+        self.audit('login', user=username, method='password', success=True)
         cherrypy.log(f'User ["{username}"] logged in', context='WEBAPP', severity=logging.INFO, traceback=False)
         return # credentials ok; all set
 
     def login_screen(self, from_page='..', username='', error_msg='', **kwargs):
         """Shows a login form"""
-        nodes = self.cfg.nodes
+        nodes = self.cfg.nodes if not self.cfg.federation else dict() # no node selection in federated mode
         tmpl = self.jinja_env.get_template('login.html')
         login_caption = self.cfg.login_caption
         return tmpl.render(from_page=from_page, username=username, error_msg=error_msg, nodes=nodes, login_caption=login_caption).encode('utf-8')
@@ -262,7 +578,9 @@ class WebApp():
     @cherrypy.expose
     def logout(self):
         """Ends the currently logged-in user's session"""
+        self.lock_session()
         username = cherrypy.session['username']
+        self.audit('logout')
         cherrypy.session.clear()
         cherrypy.response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         cherrypy.response.headers['Pragma'] = 'no-cache'
@@ -276,6 +594,11 @@ class WebApp():
         cherrypy.log('Error calling on_change_command', context='WEBAPP', severity=logging.ERROR, traceback=False)
 
 
+def log_metrics(app):
+    """Log the metrics of the request admission and of calls to the Proxmox API"""
+    cherrypy.log(json.dumps(app.admission.metrics()), context='ADMISSION', severity=logging.INFO, traceback=False)
+    cherrypy.log(json.dumps(upstream.metrics()), context='UPSTREAM', severity=logging.INFO, traceback=False)
+
 def run_webapp(cfg):
     """Runs the CherryPy web application with the provided configuration data"""
     #logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -292,6 +615,17 @@ def run_webapp(cfg):
     cherrypy.config.update({'server.socket_host': cfg.socket_host,
                             'server.socket_port': cfg.socket_port,
                            })
+    # Define bounded worker thread pool and queues (excess connections are answered with status 503 by the server at once,
+    # without blocking the thread accepting connections)
+    cherrypy.config.update({'server.thread_pool': cfg.server_thread_pool,
+                            'server.accepted_queue_size': cfg.server_accepted_queue_size,
+                            'server.accepted_queue_timeout': 0,
+                            'server.socket_queue_size': cfg.server_socket_queue_size,
+                           })
+    # Shed requests calling the Proxmox API when overloaded (runs before session_auth so that logins are covered as well)
+    cherrypy.tools.admission = cherrypy.Tool('before_handler', app.admission.admit, priority=40)
+    # Lock sessions without login before session_auth writes them (only needed with explicit session locking)
+    cherrypy.tools.anonymous_session_lock = cherrypy.Tool('before_handler', app.lock_anonymous_session, priority=45)
     # Disable autoreload (cannot listen at a port <1024 after dropping root privileges)
     cherrypy.config.update({'engine.autoreload.on': False})
     # Select environment
@@ -304,6 +638,9 @@ def run_webapp(cfg):
             'tools.sessions.secure': cfg.use_ssl,
             'tools.sessions.httponly': True,
             'tools.sessions.samesite': 'Strict',
+            'tools.sessions.locking': cfg.session_locking,
+            'tools.anonymous_session_lock.on': cfg.session_locking == 'explicit',
+            'tools.admission.on': True,
             'tools.staticdir.root': os.path.join(script_path, 'webroot'),
             'tools.session_auth.on': True,
             'tools.session_auth.login_screen': app.login_screen,
@@ -314,17 +651,41 @@ def run_webapp(cfg):
         },
         '/static': {
             'tools.session_auth.on': False,
+            'tools.anonymous_session_lock.on': False,
             'tools.staticdir.on': True,
             'tools.staticdir.dir': 'static'
         },
         '/favicon.ico': {
             'tools.session_auth.on': False,
+            'tools.anonymous_session_lock.on': False,
             'tools.staticfile.on': True,
             'tools.staticfile.filename': os.path.join(script_path, 'webroot', 'static', 'favicon.ico')
         }
     }
     # Start CherryPy
     cherrypy.tree.mount(app, config=app_conf)
+    # Import heavy modules in the background once the server is up
+    cherrypy.engine.subscribe('start', app.warm_up)
+    # Load the inventory snapshot (after dropping privileges so that the database is owned by the webserver user)
+    if app.inventory.enabled:
+        cherrypy.engine.subscribe('start', app.inventory.start, priority=80)
+        cherrypy.engine.subscribe('stop', app.inventory.stop)
+    # Let the threads calling federated nodes end so that the server can exit
+    cherrypy.engine.subscribe('stop', federation.shutdown)
+    # Write the audit log in the background
+    if app.audit_log.enabled:
+        cherrypy.engine.subscribe('start', app.audit_log.start)
+        cherrypy.engine.subscribe('stop', app.audit_log.stop)
+    # Schedule the expiry sweeper for each node that has service credentials configured
+    for node in (cfg.nodes or [None]):
+        if cfg.sweeper_user(node):
+            expiry_sweeper = sweeper.ExpirySweeper(cfg, node, audit_log=app.audit_log)
+            cherrypy.engine.subscribe('stop', expiry_sweeper.stop, priority=10)
+            cherrypy.process.plugins.Monitor(cherrypy.engine, expiry_sweeper.sweep, cfg.sweeper_interval(node), name=f'Expiry sweeper {node}').subscribe()
+            cherrypy.log(f'Expiry sweeper for node [{node}] scheduled every {cfg.sweeper_interval(node)} seconds', context='SETUP', severity=logging.INFO, traceback=False)
+    # Log the metrics of the request admission (queue depth, shed requests) and of calls to the Proxmox API periodically
+    if cfg.metrics_interval > 0:
+        cherrypy.process.plugins.Monitor(cherrypy.engine, lambda: log_metrics(app), cfg.metrics_interval, name='Metrics').subscribe()
     if setupenv.is_root():
         # Drop privileges
         cherrypy.log(f'MyProx was started as root; attempting to drop privileges to user "{cfg.webserver_user}" and group "{cfg.webserver_group}"', context='SETUP', severity=logging.INFO, traceback=False)
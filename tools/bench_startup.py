@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""bench_startup.py: measure MyProx import time, time until the server is ready and login latency against a stub Proxmox API."""
+
+# Usage: python3 tools/bench_startup.py [--runs 5] [--logins 20]
+
+import argparse
+import grp
+import os
+import pwd
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+import stubprox
+
+
+src_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+run_myprox = 'import sys; import myprox.config; myprox.config.config_filename = sys.argv[1]; import myprox; myprox.main()'
+
+
+def free_port():
+    """Return a currently unused tcp port"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def write_config(directory, port, api_port):
+    """Write a MyProx config file using the stub Proxmox API; returns its filename"""
+    filename = os.path.join(directory, 'myprox.conf')
+    with open(filename, 'w') as f:
+        f.write(f'''[myprox]
+socket_host = 127.0.0.1
+socket_port = {port}
+environment = production
+webserver_user = {pwd.getpwuid(os.getuid()).pw_name}
+webserver_group = {grp.getgrgid(os.getgid()).gr_name}
+proxmox_api = 127.0.0.1:{api_port}
+proxmox_api_verifyssl = 0
+''')
+    return filename
+
+def measure_import(runs):
+    """Measure the time for importing the web application module in a fresh interpreter"""
+    code = 'import time; t = time.perf_counter(); import myprox.webapp; print(time.perf_counter() - t)'
+    env = dict(os.environ, PYTHONPATH=src_path)
+    return [ float(subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout) for i in range(runs) ]
+
+def measure_ready(config_filename, port):
+    """Start MyProx and measure the time until it answers HTTP requests; returns (seconds, process)"""
+    env = dict(os.environ, PYTHONPATH=src_path)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', run_myprox, config_filename], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/', timeout=1)
+            return time.perf_counter() - start, process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise Exception('MyProx terminated unexpectedly')
+            time.sleep(0.005)
+
+def measure_logins(port, logins):
+    """Measure the latency of logins (each with a new session)"""
+    result = []
+    for i in range(logins):
+        session = requests.Session()
+        start = time.perf_counter()
+        response = session.post(f'http://127.0.0.1:{port}/do_login', data={'username': f'user{i}', 'password': 'secret', 'from_page': '/'}, allow_redirects=False)
+        result.append(time.perf_counter() - start)
+        if response.status_code != 303:
+            raise Exception(f'Login failed with status code {response.status_code}')
+    return result
+
+def summary(values):
+    """Format timing values (in seconds) as milliseconds"""
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    return f'min {values[0] * 1000:7.1f} ms   median {statistics.median(values) * 1000:7.1f} ms   p95 {p95 * 1000:7.1f} ms   max {values[-1] * 1000:7.1f} ms'
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup and login latency benchmark for MyProx')
+    parser.add_argument('--runs', type=int, default=5, help='number of server starts')
+    parser.add_argument('--logins', type=int, default=20, help='number of logins per server start')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='myprox-bench-')
+    server = stubprox.start_server(stubprox.StubProxmox(), certdir=directory)
+    imports, readies, first_logins, logins = [], [], [], []
+    imports = measure_import(args.runs)
+    for i in range(args.runs):
+        port = free_port()
+        config_filename = write_config(directory, port, server.server_address[1])
+        ready, process = measure_ready(config_filename, port)
+        try:
+            readies.append(ready)
+            times = measure_logins(port, args.logins)
+            first_logins.append(times[0])
+            logins.extend(times[1:])
+        finally:
+            process.terminate()
+            process.wait()
+    print(f'import myprox.webapp   {summary(imports)}')
+    print(f'start until ready      {summary(readies)}')
+    print(f'first login            {summary(first_logins)}')
+    if logins:
+        print(f'subsequent logins      {summary(logins)}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
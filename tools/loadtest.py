@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""loadtest.py: simulate many concurrent MyProx users and report throughput and latency per handler."""
+
+# Usage:
+#   python3 tools/loadtest.py --users 50 --duration 60
+#     starts a stub Proxmox API and MyProx itself, then runs the scenario against them
+#   python3 tools/loadtest.py --url http://myprox-test:8080 --users 50 --duration 60
+#     runs the scenario against a running MyProx (which should use tools/stubprox.py as its Proxmox API)
+#
+# Scenario per simulated user: login, then repeatedly load the machine list, open the management page
+# of a random machine, trigger an action on it and download the console file of a running machine
+
+import argparse
+import collections
+import random
+import re
+import tempfile
+import threading
+import time
+
+import requests
+
+import bench_startup
+import stubprox
+
+
+class LoadTest():
+    """Runs the user scenario with many concurrent users and collects latencies per handler"""
+
+    def __init__(self, url, users, duration, think_time=0.0, password='secret'):
+        """Object initialization"""
+        self.url = url.rstrip('/')
+        self.users = users
+        self.duration = duration
+        self.think_time = think_time
+        self.password = password
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.shed = collections.Counter() # requests rejected by MyProx' admission control (status 503; included in errors)
+        self.elapsed = None
+
+    def request(self, handler, session, method, path, **kwargs):
+        """Do a request, record its latency and return the response (None on error)"""
+        start = time.perf_counter()
+        try:
+            response = session.request(method, self.url + path, allow_redirects=False, timeout=60, **kwargs)
+            ok = response.status_code < 400
+            shed = response.status_code == 503
+        except requests.RequestException:
+            response, ok, shed = None, False, False
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.latencies[handler].append(latency)
+            if not ok:
+                self.errors[handler] += 1
+            if shed:
+                self.shed[handler] += 1
+        return response if ok else None
+
+    def pause(self):
+        """Simulate user think time"""
+        if self.think_time:
+            time.sleep(random.uniform(0, 2 * self.think_time))
+
+    def user(self, number, deadline):
+        """Scenario of a single user"""
+        session = requests.Session()
+        response = self.request('login', session, 'POST', '/do_login', data={'username': f'loadtest{number}', 'password': self.password, 'from_page': '/'})
+        if response is None:
+            return
+        while time.monotonic() < deadline:
+            self.pause()
+            response = self.request('index', session, 'GET', '/')
+            if response is None:
+                continue
+            running = re.findall(r'name="id" value="([^"]+)" formaction="console"', response.text)
+            ids = re.findall(r'name="id" value="([^"]+)" formaction="manage"', response.text)
+            if not ids:
+                continue
+            id = random.choice(ids)
+            self.pause()
+            self.request('manage', session, 'GET', '/manage', params={'id': id})
+            self.pause()
+            self.request('action', session, 'GET', '/manage', params={'id': id, 'action_selection': random.choice(['reboot', 'resume'])})
+            if running:
+                self.pause()
+                self.request('console', session, 'GET', '/console', params={'id': random.choice(running)})
+        self.request('logout', session, 'GET', '/logout')
+
+    def run(self):
+        """Run the scenario with all users concurrently"""
+        deadline = time.monotonic() + self.duration
+        threads = [ threading.Thread(target=self.user, args=(i, deadline), daemon=True) for i in range(self.users) ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+
+    def percentile(self, values, percent):
+        """Return the given percentile of the sorted values"""
+        return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+    def report(self):
+        """Print throughput and latency percentiles per handler"""
+        print(f'{self.users} users, {self.elapsed:.1f} s')
+        print(f'{"handler":10} {"requests":>9} {"errors":>7} {"shed":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+        total = 0
+        for handler in ['login', 'index', 'manage', 'action', 'console', 'logout']:
+            values = sorted(self.latencies.get(handler, []))
+            if not values:
+                continue
+            total += len(values)
+            print(f'{handler:10} {len(values):9d} {self.errors[handler]:7d} {self.shed[handler]:7d} {len(values) / self.elapsed:8.1f} '
+                  f'{self.percentile(values, 50) * 1000:8.1f} {self.percentile(values, 95) * 1000:8.1f} '
+                  f'{self.percentile(values, 99) * 1000:8.1f} {values[-1] * 1000:8.1f}')
+        print(f'{"total":10} {total:9d} {sum(self.errors.values()):7d} {sum(self.shed.values()):7d} {total / self.elapsed:8.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for MyProx')
+    parser.add_argument('--url', help='URL of a running MyProx instance (default: start stub Proxmox API and MyProx locally)')
+    parser.add_argument('--users', type=int, default=20, help='number of concurrent users')
+    parser.add_argument('--duration', type=float, default=30, help='test duration in seconds')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean pause between user interactions in seconds')
+    parser.add_argument('--machines', type=int, default=100, help='number of machines of the local stub Proxmox API')
+    parser.add_argument('--latency', type=float, default=0.02, help='artificial latency per call of the local stub Proxmox API in seconds')
+    parser.add_argument('--config', default='', help='additional MyProx config lines for the local instance (e.g. "dryrun = 1")')
+    args = parser.parse_args()
+    process = None
+    if args.url is None:
+        directory = tempfile.mkdtemp(prefix='myprox-loadtest-')
+        server = stubprox.start_server(stubprox.StubProxmox(machines=args.machines, latency=args.latency), certdir=directory)
+        port = bench_startup.free_port()
+        config_filename = bench_startup.write_config(directory, port, server.server_address[1])
+        with open(config_filename, 'a') as f:
+            f.write(args.config.replace('\\n', '\n') + '\n')
+        ready, process = bench_startup.measure_ready(config_filename, port)
+        args.url = f'http://127.0.0.1:{port}'
+    try:
+        loadtest = LoadTest(args.url, args.users, args.duration, args.think_time)
+        loadtest.run()
+        loadtest.report()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
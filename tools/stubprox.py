@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""stubprox.py: minimal stand-in for the Proxmox VE API, used for benchmarking and load testing MyProx."""
+
+# Usage: python3 tools/stubprox.py --port 8006 --machines 200 --latency 0.02
+# MyProx config: proxmox_api = 127.0.0.1:8006, proxmox_api_verifyssl = 0
+# Any username is accepted; the password "wrong" is rejected
+
+import argparse
+import http.server
+import json
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+class StubProxmox():
+    """In-memory state of a fake Proxmox cluster"""
+
+    def __init__(self, nodes=2, machines=100, latency=0.0, cluster='stub'):
+        """Object initialization: create a cluster with the given name and number of nodes and virtual machines"""
+        self.latency = latency
+        self.cluster = cluster
+        self.lock = threading.Lock()
+        self.nodes = [ f'pve{i + 1}' for i in range(nodes) ]
+        self.machines = dict()
+        self.tasks = dict()
+        for i in range(machines):
+            vmid = 100 + i
+            self.machines[vmid] = {
+                'vmid': vmid,
+                'type': 'lxc' if (i % 4 == 3) else 'qemu',
+                'name': f'vm{vmid}',
+                'node': self.nodes[i % nodes],
+                'status': 'running' if (i % 3) else 'stopped',
+                'maxmem': 4294967296,
+                'maxdisk': 34359738368,
+                'cpus': 2,
+                'tags': f'myprox_expiry.{2024 + (i % 4)}-12-31',
+            }
+
+    def machine_data(self, vm):
+        """Return the data of a machine as listed by Proxmox"""
+        running = (vm['status'] == 'running')
+        item = vm.copy()
+        item['mem'] = vm['maxmem'] // 2 if running else 0
+        item['uptime'] = 3600 if running else 0
+        item['cpu'] = 0.05 if running else 0
+        return item
+
+    def rrd_data(self, vm):
+        """Return a usage history (70 data points like Proxmox' "hour" timeframe)"""
+        now = int(time.time())
+        result = []
+        for i in range(70):
+            row = {'time': now - (70 - i) * 60}
+            if vm['status'] == 'running':
+                row.update({'cpu': random.uniform(0, 0.5), 'maxcpu': vm['cpus'], 'mem': random.uniform(0.2, 0.8) * vm['maxmem'], 'maxmem': vm['maxmem'],
+                            'netin': random.uniform(0, 1e5), 'netout': random.uniform(0, 1e5), 'diskread': random.uniform(0, 1e6), 'diskwrite': random.uniform(0, 1e6)})
+            result.append(row)
+        return result
+
+    def create_task(self, node, vmid, task_type):
+        """Register a (finished) task and return its UPID"""
+        upid = f'UPID:{node}:{os.getpid():08X}:{random.getrandbits(32):08X}:{int(time.time()):08X}:{task_type}:{vmid}:stub@pve:'
+        self.tasks[upid] = {'upid': upid, 'node': node, 'type': task_type, 'id': str(vmid), 'status': 'stopped', 'exitstatus': 'OK',
+                            'starttime': int(time.time()), 'endtime': int(time.time()), 'user': 'stub@pve'}
+        return upid
+
+    def handle(self, method, path, params):
+        """Handle an API call; returns (status code, data) with data being the error message in case of errors"""
+        parts = [ part for part in path.split('/') if part ]
+        with self.lock:
+            if parts == ['access', 'ticket'] and method == 'POST':
+                if params.get('password') == 'wrong':
+                    return 401, None
+                return 200, {'ticket': f'PVE:{params.get("username")}:STUB', 'CSRFPreventionToken': 'STUB', 'username': params.get('username')}
+            if parts == ['nodes']:
+                return 200, [ {'node': node, 'status': 'online'} for node in self.nodes ]
+            if parts == ['cluster', 'status']:
+                result = [ {'type': 'node', 'id': f'node/{node}', 'name': node, 'ip': f'10.0.0.{i + 1}', 'nodeid': i + 1, 'online': 1}
+                           for i, node in enumerate(self.nodes) ]
+                return 200, [{'type': 'cluster', 'id': 'cluster', 'name': self.cluster, 'nodes': len(self.nodes), 'quorate': 1}] + result
+            if parts == ['cluster', 'resources']:
+                result = []
+                for vm in self.machines.values():
+                    item = self.machine_data(vm)
+                    item.update({'id': f'{vm["type"]}/{vm["vmid"]}', 'maxcpu': vm['cpus']})
+                    result.append(item)
+                return 200, result
+            if (len(parts) == 3) and (parts[0] == 'nodes') and (parts[2] in ['qemu', 'lxc']):
+                return 200, [ self.machine_data(vm) for vm in self.machines.values() if (vm['node'] == parts[1]) and (vm['type'] == parts[2]) ]
+            if (len(parts) >= 4) and (parts[0] == 'nodes') and (parts[2] in ['qemu', 'lxc']):
+                vm = self.machines.get(int(parts[3]))
+                if (vm is None) or (vm['node'] != parts[1]) or (vm['type'] != parts[2]):
+                    return 500, None
+                rest = parts[4:]
+                if rest == ['status', 'current']:
+                    item = self.machine_data(vm)
+                    if vm['type'] == 'qemu':
+                        item['qmpstatus'] = vm.get('qmpstatus', vm['status'])
+                    return 200, item
+                if (len(rest) == 2) and (rest[0] == 'status') and (method == 'POST'):
+                    if (rest[1] == 'start') and (vm['status'] == 'running'):
+                        return 500, f'VM {vm["vmid"]} already running'
+                    vm['status'] = 'stopped' if rest[1] in ['shutdown', 'stop'] else 'running'
+                    vm['qmpstatus'] = 'paused' if rest[1] == 'suspend' else vm['status']
+                    prefix = 'qm' if vm['type'] == 'qemu' else 'vz'
+                    return 200, self.create_task(vm['node'], vm['vmid'], f'{prefix}{rest[1]}')
+                if rest == ['config']:
+                    if method == 'PUT':
+                        if params.get('digest', str(hash(vm['tags']))) != str(hash(vm['tags'])):
+                            return 500, 'detected modified configuration - file changed by other user? Try again.'
+                        vm['tags'] = params.get('tags', vm['tags'])
+                        return 200, None
+                    return 200, {'name': vm['name'], 'tags': vm['tags'], 'digest': str(hash(vm['tags']))}
+                if rest == ['rrddata']:
+                    return 200, self.rrd_data(vm)
+                if rest == ['spiceproxy']:
+                    return 200, {'type': 'spice', 'host': f'pvespiceproxy:{vm["vmid"]}', 'proxy': 'http://127.0.0.1:3128', 'password': 'stub'}
+            if (len(parts) == 5) and (parts[0] == 'nodes') and (parts[2] == 'tasks') and (parts[4] == 'status'):
+                task = self.tasks.get(parts[3])
+                return (200, task) if task else (500, None)
+            if parts == ['cluster', 'tasks']:
+                # Like Proxmox, only list the most recent tasks
+                return 200, sorted(self.tasks.values(), key=lambda task: task['starttime'], reverse=True)[:50]
+            if parts == ['access', 'permissions']:
+                return 200, {'/vms': {'VM.Audit': 1, 'VM.Console': 1, 'VM.PowerMgmt': 1, 'VM.Config.Options': 1}}
+            if (len(parts) == 3) and (parts[:2] == ['access', 'roles']):
+                return 200, {'VM.Audit': 1, 'VM.Console': 1, 'VM.PowerMgmt': 1}
+        return 501, None
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler serving the stub API under /api2/json"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Don't log each request"""
+        pass
+
+    def do_request(self, method):
+        """Dispatch a request to the stub"""
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+        if self.server.stub.latency:
+            time.sleep(self.server.stub.latency)
+        status, data = 404, None
+        if url.path.startswith('/api2/json/'):
+            status, data = self.server.stub.handle(method, url.path[len('/api2/json'):], params)
+        body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(status, data if (status >= 400) and isinstance(data, str) else None)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.do_request('GET')
+
+    def do_POST(self):
+        self.do_request('POST')
+
+    def do_PUT(self):
+        self.do_request('PUT')
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """Threading HTTPS server doing the TLS handshake in the request thread (not in the accepting one)"""
+
+    daemon_threads = True
+
+    def finish_request(self, request, client_address):
+        """Wrap the connection with TLS before handling it"""
+        request = self.context.wrap_socket(request, server_side=True)
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            request.close()
+
+
+def create_certificate(directory):
+    """Create a self-signed certificate for the stub server using openssl; returns the filenames of certificate and key"""
+    certfile = os.path.join(directory, 'stub-cert.pem')
+    keyfile = os.path.join(directory, 'stub-key.pem')
+    subprocess.run(['openssl', 'req', '-nodes', '-x509', '-newkey', 'rsa:2048', '-keyout', keyfile, '-out', certfile,
+                    '-days', '1', '-subj', '/CN=localhost'], check=True, capture_output=True)
+    return certfile, keyfile
+
+def start_server(stub, host='127.0.0.1', port=0, certdir=None):
+    """Start the stub server in a background thread; returns the server (its port is server.server_address[1])"""
+    if certdir is None:
+        certdir = tempfile.mkdtemp(prefix='stubprox-')
+    certfile, keyfile = create_certificate(certdir)
+    server = StubServer((host, port), RequestHandler)
+    server.stub = stub
+    server.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server.context.load_cert_chain(certfile, keyfile)
+    threading.Thread(target=server.serve_forever, name='Stub Proxmox API', daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub Proxmox VE API for testing MyProx')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8006, help='port to listen on')
+    parser.add_argument('--nodes', type=int, default=2, help='number of cluster nodes')
+    parser.add_argument('--machines', type=int, default=100, help='number of virtual machines')
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial latency per API call in seconds')
+    parser.add_argument('--cluster', default='stub', help='name of the cluster')
+    args = parser.parse_args()
+    server = start_server(StubProxmox(args.nodes, args.machines, args.latency, args.cluster), args.host, args.port)
+    print(f'Stub Proxmox API listening on https://{args.host}:{server.server_address[1]}/api2/json')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()